@@ -0,0 +1,387 @@
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import yaml
+from PIL import Image, ImageEnhance
+
+import utils
+import similarity
+from io_pool import io_pool, inject_latency, IO_WORKERS
+
+
+def bench_phash_decode(folder: str, limit: int = 200):
+    """
+    对比全尺寸解码和快速解码计算 pHash 的耗时，按文件格式分别统计
+    :param folder: 图片所在文件夹
+    :param limit: 每种格式最多测试多少张
+    """
+    files: dict[str, list[str]] = defaultdict(list)  # suffix: [path, ...]
+    for batch in utils.load_media_batch(folder, 64, media_type=utils.MediaType.all_image(), all_files=True):
+        for entry in batch:
+            suffix = Path(entry.name).suffix.lower()
+            if len(files[suffix]) < limit:
+                files[suffix].append(entry.path)
+
+    print(f'{"format":<8}{"count":>8}{"full(ms)":>12}{"fast(ms)":>12}{"speedup":>10}{"max diff":>10}')
+    for suffix, paths in sorted(files.items()):
+        full_time = 0.0
+        fast_time = 0.0
+        max_diff = 0
+        for path in paths:
+            start = time.perf_counter()
+            full_hash = similarity.compute_phash_from_path(path)
+            full_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            fast_hash = similarity.compute_phash_from_path(path, fast=True)
+            fast_time += time.perf_counter() - start
+
+            max_diff = max(max_diff, similarity.hamming_distance(full_hash, fast_hash))
+
+        n = len(paths)
+        print(f'{suffix:<8}{n:>8}{full_time / n * 1000:>12.2f}{fast_time / n * 1000:>12.2f}'
+              f'{full_time / fast_time:>9.2f}x{max_diff:>10}')
+
+
+# 合成图库的文件夹和时区配置，trip 覆盖 root 的时区，trip/day1 只在部分时间段覆盖 trip
+synthetic_config = {
+    'tz': [{'name': 'Asia/Shanghai'}],
+    'folder': [
+        {'name': 'home'},
+        {'name': 'trip', 'tz': [
+            {'name': 'America/Los_Angeles', 'ranges': [{'from': datetime.fromisoformat('2024-03-01T00:00:00+08:00'),
+                                                        'to': datetime.fromisoformat('2024-09-01T00:00:00+08:00')}],
+             'save_as': 'Asia/Shanghai'},
+        ], 'folder': [
+            {'name': 'day1', 'tz': [
+                {'name': 'America/Phoenix', 'ranges': [{'from': datetime.fromisoformat('2024-04-01T00:00:00+08:00'),
+                                                        'to': datetime.fromisoformat('2024-04-15T00:00:00+08:00')}]},
+            ]},
+        ]},
+    ],
+}
+
+# 最小的 QuickTime 文件头，只用于让 live 图的视频能被按文件头识别
+mov_header = b'\x00\x00\x00\x14ftypqt  \x00\x00\x00\x00qt  '
+
+
+def _make_exif(dt: datetime) -> bytes:
+    exif = Image.Exif()
+    exif_ifd = exif.get_ifd(0x8769)
+    exif_ifd[0x9003] = dt.strftime('%Y:%m:%d %H:%M:%S')  # DateTimeOriginal
+    exif_ifd[0x9011] = '+08:00'  # OffsetTimeOriginal
+    return exif.tobytes()
+
+
+def _make_image(path: str, seed: int, variant: int, dt: datetime, size: tuple[int, int] = (256, 192)):
+    """
+    生成一张合成图片，同一个 seed 的图片内容相同，variant 不为 0 时生成轻微变化的近似图片
+    只传基本类型，可以在进程池中运行
+    """
+    rng = np.random.default_rng(seed)
+    # 低频随机图案放大，不同 seed 的 pHash 差别足够大
+    pattern = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    img = Image.fromarray(pattern).resize(size, Image.Resampling.BICUBIC)
+    if variant == 1:
+        img = img.resize((size[0] * 9 // 10, size[1] * 9 // 10))
+    elif variant == 2:
+        img = ImageEnhance.Brightness(img).enhance(1.05)
+
+    suffix = Path(path).suffix.lower()
+    exif = _make_exif(dt)
+    if suffix == '.png':
+        img.save(path, format='PNG')
+    elif suffix == '.heic':
+        img.save(path, format='HEIF', quality=80, exif=exif)
+    else:
+        img.save(path, format='JPEG', quality=90 if variant == 0 else 70, exif=exif)
+    timestamp = dt.timestamp()
+    os.utime(path, (timestamp, timestamp))
+
+
+def generate_library(root: str, n: int, seed: int = 0, duplicate_ratio: float = 0.1, live_ratio: float = 0.05,
+                     workers: int = None) -> utils.Folder:
+    """
+    生成合成图库：jpg、png、heic 图片，其中一部分是近似重复的图片，一部分是 live 图（同名的 heic + mov）
+    live 图只按文件名配对，不写入 ContentIdentifier（需要 exiftool 才能写入）
+    :param root: 图库根文件夹，已存在时先删除
+    :param n: 图片数量（不包括 live 图的视频）
+    :param duplicate_ratio: 近似重复图片的比例
+    :param live_ratio: live 图的比例
+    :return: 和 folders.yaml 格式相同的配置，同时写入 root/folders.yaml
+    """
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    folder_names = ['', 'home', 'trip', os.path.join('trip', 'day1')]
+    for name in folder_names:
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    config = {'folder': [dict(synthetic_config, name=os.path.abspath(root))]}
+    with open(os.path.join(root, 'folders.yaml'), 'w', encoding='utf-8') as f:
+        yaml.dump(config, f, allow_unicode=True)
+
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    jobs = []  # (path, seed, variant, dt)
+    for i in range(n):
+        folder = os.path.join(root, rng.choice(folder_names))
+        dt = start + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        r = rng.random()
+        if r < duplicate_ratio and i > 0:
+            # 和之前某张图片内容相同的近似图片
+            jobs.append((os.path.join(folder, f'DUP_{i:06d}.jpg'), rng.randrange(i), rng.choice([1, 2]), dt))
+        elif r < duplicate_ratio + live_ratio:
+            path = os.path.join(folder, f'IMG_{i:06d}.HEIC')
+            jobs.append((path, i, 0, dt))
+            mov_path = str(Path(path).with_suffix('.MOV'))
+            with open(mov_path, 'wb') as f:
+                f.write(mov_header)
+            os.utime(mov_path, (dt.timestamp(), dt.timestamp()))
+        else:
+            suffix = rng.choices(['.jpg', '.png', '.heic'], weights=[7, 2, 1])[0]
+            jobs.append((os.path.join(folder, f'IMG_{i:06d}{suffix}'), i, 0, dt))
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for _ in executor.map(_make_image, *zip(*jobs), chunksize=64):
+            pass
+
+    return utils.load_config(os.path.join(root, 'folders.yaml'))
+
+
+def peak_rss_mb() -> float | None:
+    """
+    当前进程的内存峰值（MB），不包括进程池中的子进程
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 单位为 KB，macOS 为字节
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024  # Windows
+    except (ImportError, AttributeError):
+        return None
+
+
+class StageResult:
+    def __init__(self, name: str, seconds: float, items: int, peak_rss: float | None, extra: dict = None):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+        self.peak_rss = peak_rss
+        self.extra = extra or {}
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'seconds': self.seconds, 'items': self.items, 'throughput': self.throughput,
+                'peak_rss_mb': self.peak_rss, **self.extra}
+
+    def __str__(self):
+        rss = f'{self.peak_rss:.0f}' if self.peak_rss is not None else '-'
+        return f'{self.name:<18}{self.items:>10}{self.seconds:>10.2f}{self.throughput:>12.1f}{rss:>10}'
+
+
+def run_stage(name: str, func, results: list[StageResult], quiet: bool = True) -> object:
+    """
+    运行并计时一个阶段，func 返回 (结果, 处理数量) 或 (结果, 处理数量, 额外信息)
+    :param quiet: 不输出阶段内部的 print
+    """
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        value, items, *extra = func()
+    result = StageResult(name, time.perf_counter() - start, items, peak_rss_mb(), extra[0] if extra else None)
+    results.append(result)
+    print(result)
+    return value
+
+
+def _bench_rename(folders: utils.Folder) -> tuple[list, int]:
+    import rename
+
+    moves = []
+    for folder in folders:
+        file_entry_map = {'': []}
+        for batch in utils.load_media_batch(folder.path, 64, media_type=utils.MediaType.all_media(), all_files=False):
+            for uuid, files in utils.get_file_entry_map(batch).items():
+                file_entry_map.setdefault(uuid, []).extend(files)
+            moves.extend(rename.plan_rename(folder, file_entry_map))
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        rename.apply_plan(moves, folders.path, executor)
+    return moves, len(moves)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def run_suite(n: int, work_dir: str, results_dir: str = 'benchmark_results', workers: int = None) -> str:
+    """
+    生成 n 张图片的合成图库，依次计时 扫描、pHash、MinHash、相似查询、重命名 各阶段
+    结果写入 results_dir/bench_{n}_{commit}.json，可以用 compare_results 对比两次提交
+    :return: 结果文件路径
+    """
+    workers = workers or os.cpu_count()
+    root = os.path.join(work_dir, f'library_{n}')
+    print(f'Generating {n} images in {root}')
+    start = time.perf_counter()
+    folders = generate_library(root, n, workers=workers)
+    print(f'Generated in {time.perf_counter() - start:.1f}s')
+
+    results: list[StageResult] = []
+    print(f'{"stage":<18}{"items":>10}{"seconds":>10}{"items/s":>12}{"rss(MB)":>10}')
+
+    def scan():
+        entries = [entry for folder in folders
+                   for batch in utils.load_media_batch(folder.path, 64, media_type=utils.MediaType.all_image(), all_files=True)
+                   for entry in batch]
+        return entries, len(entries)
+    image_entries = run_stage('load_media_batch', scan, results)
+
+    def phash():
+        phash_db = similarity.generate_cache(folders, workers=workers, image_entries=image_entries)
+        return phash_db, len(phash_db)
+    phash_db = run_stage('phash', phash, results)
+    run_stage('phash_cached', phash, results)  # 第二次运行全部命中 cache.db
+
+    def minhash():
+        return None, len([similarity.hash_to_minhash(h) for h in phash_db.values()])
+    run_stage('hash_to_minhash', minhash, results)
+
+    for mode in ('exact', 'blocked'):
+        def query():
+            groups = similarity.query_similar_images(folders, phash_db, mode=mode, workers=workers, image_entries=image_entries)
+            return groups, len(image_entries), {'groups': len(groups)}
+        run_stage(f'query_{mode}', query, results)
+
+    # 重命名需要 exiftool 读取 EXIF，会移动文件，放在最后
+    if shutil.which('exiftool'):
+        run_stage('rename', lambda: _bench_rename(folders), results)
+    else:
+        print('exiftool not found, rename skipped')
+
+    os.makedirs(results_dir, exist_ok=True)
+    commit = git_commit()
+    result_file = os.path.join(results_dir, f'bench_{n}_{commit}.json')
+    with open(result_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'scale': n,
+            'workers': workers,
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'stages': [result.to_dict() for result in results],
+        }, f, indent=4)
+    print(f'Results saved to {result_file}')
+    return result_file
+
+
+def bench_io_latency(n: int, work_dir: str, latencies: tuple[float, ...] = (0.005, 0.01, 0.02),
+                     results_dir: str = 'benchmark_results') -> str:
+    """
+    在本机模拟网络文件系统（每次 scandir、stat、rename 等待 latency 秒），对比 io_pool 单线程（和原来逐个调用相同）
+    和 IO_WORKERS 个线程时，扫描（列出 year/month 文件夹并读取 stat）和执行重命名计划的耗时
+    :param n: 文件数，分布在 2 年 24 个月份文件夹中，内容为空
+    :return: 结果文件路径
+    """
+    import rename
+
+    root = os.path.join(work_dir, f'io_{n}')
+    shutil.rmtree(root, ignore_errors=True)
+    paths = []
+    for i in range(n):
+        folder = os.path.join(root, str(2023 + i % 2), f'{i % 12 + 1:02d}')
+        os.makedirs(folder, exist_ok=True)
+        paths.append(os.path.join(folder, f'IMG_{i:06d}.jpg'))
+        open(paths[-1], 'wb').close()
+
+    def scan():
+        entries = [entry for batch in utils.load_media_batch(root, 64, media_type=utils.MediaType.all_image(), all_files=True)
+                   for entry in batch]
+        for entry in entries:
+            entry.stat()  # 后续阶段需要的大小、修改时间，load_media_batch 已经并发读取时直接使用缓存
+        return len(entries)
+
+    def move(forward: bool):
+        # 来回移动，每次运行前后文件位置相同
+        moves = [rename.Move(path, path[:-4] + '_r.jpg') if forward else rename.Move(path[:-4] + '_r.jpg', path)
+                 for path in paths]
+        rename.apply_plan(moves, root)
+        return len(moves)
+
+    results = []
+    print(f'{"latency(ms)":>12}{"stage":>8}{"sequential(s)":>15}{"pooled(s)":>12}{"speedup":>10}')
+    for latency in latencies:
+        for stage, funcs in (('scan', (scan, scan)), ('rename', (lambda: move(True), lambda: move(False)))):
+            seconds = []
+            for workers, func in zip((1, IO_WORKERS), funcs):
+                io_pool.set_workers(workers)
+                with inject_latency(latency), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    items = func()
+                    seconds.append(time.perf_counter() - start)
+            speedup = seconds[0] / seconds[1] if seconds[1] > 0 else float('inf')
+            print(f'{latency * 1000:>12.0f}{stage:>8}{seconds[0]:>15.2f}{seconds[1]:>12.2f}{speedup:>9.1f}x')
+            results.append({'latency_ms': latency * 1000, 'stage': stage, 'items': items,
+                            'sequential_seconds': seconds[0], 'pooled_seconds': seconds[1], 'speedup': speedup})
+    io_pool.set_workers(IO_WORKERS)
+    shutil.rmtree(root, ignore_errors=True)
+
+    os.makedirs(results_dir, exist_ok=True)
+    commit = git_commit()
+    result_file = os.path.join(results_dir, f'io_latency_{n}_{commit}.json')
+    with open(result_file, 'w', encoding='utf-8') as f:
+        json.dump({'commit': commit, 'time': datetime.now().isoformat(timespec='seconds'), 'scale': n,
+                   'workers': IO_WORKERS, 'results': results}, f, indent=4)
+    print(f'Results saved to {result_file}')
+    return result_file
+
+
+def compare_results(old_file: str, new_file: str):
+    """
+    对比两次 run_suite 的结果，speedup > 1 表示新的更快
+    """
+    with open(old_file, 'r', encoding='utf-8') as f:
+        old = {stage['name']: stage for stage in json.load(f)['stages']}
+    with open(new_file, 'r', encoding='utf-8') as f:
+        new = {stage['name']: stage for stage in json.load(f)['stages']}
+
+    print(f'{"stage":<18}{"old(s)":>10}{"new(s)":>10}{"speedup":>10}')
+    for name, stage in new.items():
+        if name not in old:
+            continue
+        speedup = old[name]['seconds'] / stage['seconds'] if stage['seconds'] > 0 else float('inf')
+        print(f'{name:<18}{old[name]["seconds"]:>10.2f}{stage["seconds"]:>10.2f}{speedup:>9.2f}x')
+
+
+if __name__ == '__main__':
+    # bench_phash_decode(os.getcwd())
+
+    scales = [1000]  # 可以改为 [1000, 10000, 100000]，100000 张时生成图库需要几 GB 空间
+    work_dir = os.path.join(os.getcwd(), '.benchmark')
+    for scale in scales:
+        run_suite(scale, work_dir)
+    # bench_io_latency(1000, work_dir)  # 模拟网络文件系统的延迟
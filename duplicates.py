@@ -0,0 +1,115 @@
+import hashlib
+import mmap
+import nt
+import os
+from collections import defaultdict
+
+import utils
+from instrument import stats
+from io_pool import io_pool
+
+
+# 部分摘要读取文件开头和结尾各 CHUNK_SIZE 字节
+CHUNK_SIZE = 64 * 1024
+
+
+def partial_digest(path: str, size: int) -> str:
+    """
+    文件开头和结尾的摘要，大小相同的不同照片几乎都能在这一步区分开
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= 2 * CHUNK_SIZE:
+            h.update(f.read())
+        else:
+            h.update(f.read(CHUNK_SIZE))
+            f.seek(-CHUNK_SIZE, os.SEEK_END)
+            h.update(f.read(CHUNK_SIZE))
+    return h.hexdigest()
+
+
+def full_digest(path: str) -> str:
+    """
+    整个文件的摘要，用 mmap 按顺序读取，不需要在 Python 中分块复制
+    """
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()  # 空文件不能 mmap
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            h.update(m)
+    return h.hexdigest()
+
+
+def _refine(groups: list[list[nt.DirEntry]], digest) -> list[list[nt.DirEntry]]:
+    """
+    按 digest(entry) 把每组再细分，只保留大于 1 个元素的组，读取在 io_pool 中并发执行
+    """
+    entries = [entry for group in groups for entry in group]
+    digests = dict(zip((entry.path for entry in entries), io_pool.map(digest, entries)))
+    refined = []
+    for group in groups:
+        buckets: dict[str, list[nt.DirEntry]] = defaultdict(list)
+        for entry in group:
+            buckets[digests[entry.path]].append(entry)
+        refined.extend(bucket for bucket in buckets.values() if len(bucket) > 1)
+    return refined
+
+
+def find_exact_duplicates(entries: list[nt.DirEntry]) -> list[list[nt.DirEntry]]:
+    """
+    查找内容完全相同的文件，不需要解码：
+    1. 按文件大小分组，大小不同的文件不需要读取（大小来自扫描时缓存的 stat）
+    2. 大小相同的文件比较开头和结尾的摘要
+    3. 仍然相同的文件比较整个文件的摘要
+    :return: [[entry, ...], ...]，组内按 entries 中的顺序排列
+    """
+    by_size: dict[int, list[nt.DirEntry]] = defaultdict(list)
+    for entry in entries:
+        by_size[entry.stat().st_size].append(entry)
+    groups = [group for group in by_size.values() if len(group) > 1]
+
+    # 读取是 I/O 密集的，和其他文件系统操作一样在 io_pool 中并发读取
+    with stats.timer('partial_digest', sum(len(group) for group in groups)):
+        groups = _refine(groups, lambda entry: partial_digest(entry.path, entry.stat().st_size))
+
+    # 小文件的部分摘要已经是整个文件的摘要
+    small = [group for group in groups if group[0].stat().st_size <= 2 * CHUNK_SIZE]
+    large = [group for group in groups if group[0].stat().st_size > 2 * CHUNK_SIZE]
+    with stats.timer('full_digest', sum(len(group) for group in large)):
+        large = _refine(large, lambda entry: full_digest(entry.path))
+
+    # 恢复 entries 中的顺序
+    order = {entry.path: i for i, entry in enumerate(entries)}
+    groups = [sorted(group, key=lambda entry: order[entry.path]) for group in small + large]
+    groups.sort(key=lambda group: order[group[0].path])
+    return groups
+
+
+def choose_keep(group: list[nt.DirEntry]) -> nt.DirEntry:
+    """
+    内容相同时保留修改时间最早的（通常是原图，其他是之后备份的副本），相同时保留第一个
+    """
+    return min(group, key=lambda entry: entry.stat().st_mtime)
+
+
+def remove_exact_duplicates(groups: list[list[nt.DirEntry]], confirm: bool = True):
+    """
+    删除完全相同的文件，每组保留 choose_keep 选择的文件，全部列出后只确认一次
+    """
+    remove_paths = []
+    keep_paths = []
+    for group in groups:
+        keep = choose_keep(group)
+        keep_paths.append(keep.path)
+        remove_paths.extend(entry.path for entry in group if entry is not keep)
+    if not remove_paths:
+        return
+
+    utils.del_images(remove_paths, dry_run=True, keep=keep_paths)
+    print(f'{len(remove_paths)} exact duplicates in {len(groups)} groups')
+    if confirm:
+        answer = input('confirm? (Y/n): ')
+        if answer == 'n' or answer == 'N':
+            return
+    utils.del_images(remove_paths, keep=keep_paths)
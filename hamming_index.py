@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
+
+def hex_to_uint64(hashes: list[str]) -> np.ndarray:
+    """
+    将十六进制 pHash 列表转换为 uint64 数组
+    """
+    return np.array([int(h, 16) for h in hashes], dtype=np.uint64)
+
+
+class HammingIndex:
+    """
+    64 位哈希的精确汉明距离索引（multi-index hashing）
+
+    把 64 位分成 radius + 1 段，若两个哈希的汉明距离 <= radius，根据鸽巢原理至少有一段完全相同。
+    每段按值排序，查询时对每段二分查找得到候选，再用 XOR + popcount 精确验证，
+    因此返回的结果和逐对比较完全一致，不会像 MinHash LSH 一样漏掉
+    """
+    def __init__(self, hashes: np.ndarray, radius: int = 2):
+        """
+        :param hashes: uint64 数组，下标即图片的 id
+        :param radius: 最大汉明距离
+        """
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+
+        # 每段的 (起始位, 位数)
+        n_bands = radius + 1
+        widths = [64 // n_bands + (1 if i < 64 % n_bands else 0) for i in range(n_bands)]
+        self.bands: list[tuple[int, int]] = []
+        start = 0
+        for width in widths:
+            self.bands.append((start, width))
+            start += width
+
+        # 每段排序后的值和对应的 id
+        self.sorted_values: list[np.ndarray] = []
+        self.sorted_ids: list[np.ndarray] = []
+        for start, width in self.bands:
+            values = self._band_values(self.hashes, start, width)
+            order = np.argsort(values)
+            self.sorted_values.append(values[order])
+            self.sorted_ids.append(order)
+
+    @staticmethod
+    def _band_values(hashes: np.ndarray, start: int, width: int) -> np.ndarray:
+        mask = np.uint64((1 << width) - 1)
+        return (hashes >> np.uint64(start)) & mask
+
+    def candidates(self, h: int) -> np.ndarray:
+        """
+        返回至少有一段和 h 完全相同的 id（未去重）
+        """
+        query = np.array([h], dtype=np.uint64)
+        found = []
+        for (start, width), values, ids in zip(self.bands, self.sorted_values, self.sorted_ids):
+            value = self._band_values(query, start, width)[0]
+            left = np.searchsorted(values, value, side='left')
+            right = np.searchsorted(values, value, side='right')
+            if right > left:
+                found.append(ids[left:right])
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(found)
+
+    def query(self, h: int) -> list[tuple[int, int]]:
+        """
+        查询汉明距离 <= radius 的所有哈希
+        :return: [(id, dist), ...]，按 id 升序
+        """
+        ids = np.unique(self.candidates(h))
+        dists = np.bitwise_count(self.hashes[ids] ^ np.uint64(h))
+        within = dists <= self.radius
+        return list(zip(ids[within].tolist(), dists[within].tolist()))
+
+    def query_id(self, i: int) -> list[tuple[int, int]]:
+        """
+        查询和第 i 个哈希距离 <= radius 的所有哈希（包括自己）
+        """
+        return self.query(int(self.hashes[i]))
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def _scan_row_block(hashes: np.ndarray, row_start: int, radius: int, row_block: int, col_block: int):
+    """
+    计算 hashes[row_start:row_start + row_block] 和它之后所有哈希的距离，返回距离 <= radius 的 (i, j, dist)
+    """
+    n = len(hashes)
+    rows = hashes[row_start:row_start + row_block]
+    # 每个行块只分配一次缓冲区，所有列块复用
+    xor_buf = np.empty((len(rows), col_block), dtype=np.uint64)
+    count_buf = np.empty((len(rows), col_block), dtype=np.uint8)
+    mask_buf = np.empty((len(rows), col_block), dtype=bool)
+
+    found_i, found_j, found_d = [], [], []
+    # 只计算上三角，j 从 row_start 开始
+    for col_start in range(row_start, n, col_block):
+        cols = hashes[col_start:col_start + col_block]
+        width = len(cols)
+        xor, count, mask = xor_buf[:, :width], count_buf[:, :width], mask_buf[:, :width]
+        np.bitwise_xor(rows[:, None], cols[None, :], out=xor)
+        np.bitwise_count(xor, out=count)
+        np.less_equal(count, radius, out=mask)
+        if not mask.any():
+            continue
+        i, j = np.nonzero(mask)
+        dist = count[i, j]
+        i += row_start
+        j += col_start
+        upper = i < j
+        found_i.append(i[upper])
+        found_j.append(j[upper])
+        found_d.append(dist[upper])
+
+    if not found_i:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.uint8)
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_d)
+
+
+def radius_pairs_blocked(hashes: np.ndarray, radius: int = 2, row_block: int = 256, col_block: int = 16384, workers: int = 1):
+    """
+    分块暴力计算所有汉明距离 <= radius 的哈希对，每次只计算 row_block x col_block 的子矩阵，内存占用固定
+    :param workers: 线程数，numpy 计算时会释放 GIL，多线程可以用满多核
+    :return: 生成器，按行块顺序每次返回 (i, j, dist) 三个数组，i < j
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    row_starts = range(0, len(hashes), row_block)
+    scan = partial(_scan_row_block, hashes, radius=radius, row_block=row_block, col_block=col_block)
+
+    if workers <= 1:
+        results = map(scan, row_starts)
+        yield from (r for r in results if len(r[0]))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from (r for r in executor.map(scan, row_starts) if len(r[0]))
+
+
+def connected_groups(hashes: np.ndarray, radius: int = 2, workers: int = 1, pair_filter=None) -> list[list[tuple[int, int]]]:
+    """
+    把汉明距离 <= radius 的哈希连成组（连通分量）
+    :param pair_filter: 进一步验证候选对的函数，输入 (i 数组, j 数组)，返回每一对是否保留的 bool 数组
+    :return: [[(id, dist), ...], ...]，组内第一个是 id 最小的，dist 为和第一个的汉明距离，只返回大于 1 个元素的组
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    parent = list(range(len(hashes)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i_arr, j_arr, _ in radius_pairs_blocked(hashes, radius, workers=workers):
+        if pair_filter is not None:
+            keep = pair_filter(i_arr, j_arr)
+            i_arr, j_arr = i_arr[keep], j_arr[keep]
+        for i, j in zip(i_arr.tolist(), j_arr.tolist()):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                # 小的 id 作为根，保证组内第一个是 id 最小的
+                if root_i < root_j:
+                    parent[root_j] = root_i
+                else:
+                    parent[root_i] = root_j
+
+    # 根是组内最小的 id，按 id 顺序遍历时根总是第一个加入
+    members: dict[int, list[int]] = {}
+    for i in range(len(hashes)):
+        members.setdefault(find(i), []).append(i)
+
+    groups = []
+    for root, ids in members.items():
+        if len(ids) < 2:
+            continue
+        ids_arr = np.array(ids)
+        dists = np.bitwise_count(hashes[ids_arr] ^ hashes[root])
+        groups.append(list(zip(ids, dists.tolist())))
+    return groups
@@ -0,0 +1,324 @@
+import json
+import os
+import sqlite3
+
+
+# 哈希算法的版本，算法实现变化时加一，旧版本的记录会被认为过期并重新计算
+HASH_VERSION = 2  # 2: 快速解码的 JPEG 按彩色解码，colorhash 和其他格式一致
+
+# hashes 表的列，和 HashRecord 的参数顺序一致
+_columns = 'path, size, mtime, phash, algorithm, version, format, dhash, ahash, colorhash, phash_invariant'
+
+
+class HashRecord:
+    """
+    hash 表中的一行记录
+    """
+    def __init__(self, path: str, size: int, mtime: float, phash: str, algorithm: str, version: int, format: str = None,
+                 dhash: str = None, ahash: str = None, colorhash: str = None, phash_invariant: str = None):
+        self.path = path  # 相对于根文件夹的路径
+        self.size = size
+        self.mtime = mtime
+        self.phash = phash
+        self.algorithm = algorithm  # 'phash' 或 'phash_fast'
+        self.version = version
+        self.format = format  # utils.sniff_format 根据文件头判断的格式
+        # 和 pHash 由同一次解码得到的其他指纹，旧记录和从 cache.json 导入的记录没有
+        self.dhash = dhash
+        self.ahash = ahash
+        self.colorhash = colorhash
+        self.phash_invariant = phash_invariant  # 旋转、翻转不变的 pHash
+
+    def has_fingerprints(self) -> bool:
+        return (self.dhash is not None and self.ahash is not None and self.colorhash is not None
+                and self.phash_invariant is not None)
+
+    def is_fresh(self, size: int, mtime: float, algorithms: tuple[str, ...], need_fingerprints: bool = False) -> bool:
+        """
+        判断记录是否还能用：文件大小、修改时间没变，且算法和版本符合要求
+        :param need_fingerprints: 为 True 时没有 dHash、aHash、colorhash、旋转不变 pHash 的记录也需要重新计算
+        """
+        return (self.size == size and self.mtime == mtime
+                and self.algorithm in algorithms and self.version == HASH_VERSION
+                and (not need_fingerprints or self.has_fingerprints()))
+
+    def __repr__(self):
+        return f'HashRecord({self.path}, {self.phash}, {self.algorithm} v{self.version})'
+
+
+class HashIndex:
+    """
+    基于 SQLite 的 pHash 索引，按相对路径存储，每次 commit 只写入变化的行，中断时不会损坏已有数据
+    同时存放用户选择保留的相似图片组（README TODO：用数据库存下没删除的相似文件）
+    """
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.root = os.path.dirname(os.path.abspath(db_file))  # 表中的路径都相对于该文件夹
+        self.conn = sqlite3.connect(db_file)
+        # WAL 模式下写入不会阻塞读取，中断时未提交的事务直接丢弃
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                phash TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                format TEXT,
+                dhash TEXT,
+                ahash TEXT,
+                colorhash TEXT,
+                phash_invariant TEXT
+            );
+            CREATE TABLE IF NOT EXISTS indexed (
+                path TEXT PRIMARY KEY,
+                phash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS verified (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS processed (
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                PRIMARY KEY (kind, path)
+            );
+            CREATE TABLE IF NOT EXISTS live_photos (
+                path TEXT PRIMARY KEY,
+                uuid TEXT NOT NULL,
+                media TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                renamed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS live_photos_uuid ON live_photos (uuid);
+            CREATE TABLE IF NOT EXISTS kept_similar (
+                group_key TEXT PRIMARY KEY,
+                paths TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        # 旧版本的数据库没有 format 和其他指纹的列
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(hashes)')}
+        for column in ('format', 'dhash', 'ahash', 'colorhash', 'phash_invariant'):
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE hashes ADD COLUMN {column} TEXT')
+        self.conn.commit()
+
+    def get(self, path: str) -> HashRecord | None:
+        row = self.conn.execute(
+            f'SELECT {_columns} FROM hashes WHERE path = ?', (path,)
+        ).fetchone()
+        return HashRecord(*row) if row else None
+
+    def get_many(self, paths: list[str]) -> dict[str, HashRecord]:
+        """
+        一次查询多个路径，返回 path: HashRecord，不存在的路径不在结果中
+        """
+        records = {}
+        # SQLite 默认最多 999 个参数
+        for i in range(0, len(paths), 900):
+            chunk = paths[i:i + 900]
+            placeholders = ','.join('?' * len(chunk))
+            for row in self.conn.execute(
+                    f'SELECT {_columns} FROM hashes WHERE path IN ({placeholders})', chunk):
+                records[row[0]] = HashRecord(*row)
+        return records
+
+    def put_many(self, records: list[HashRecord]):
+        self.conn.executemany(
+            f'INSERT OR REPLACE INTO hashes ({_columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(r.path, r.size, r.mtime, r.phash, r.algorithm, r.version, r.format, r.dhash, r.ahash, r.colorhash,
+              r.phash_invariant) for r in records]
+        )
+
+    def all_fingerprints(self) -> dict[str, tuple[str, str, str, str]]:
+        """
+        返回 path: (dHash, aHash, colorhash, 旋转不变 pHash)，只包括有这些指纹的记录
+        """
+        return {path: tuple(fingerprints) for path, *fingerprints in self.conn.execute(
+            'SELECT path, dhash, ahash, colorhash, phash_invariant FROM hashes WHERE dhash IS NOT NULL AND ahash IS NOT NULL '
+            'AND colorhash IS NOT NULL AND phash_invariant IS NOT NULL')}
+
+    def prune(self, existing_paths: set[str]) -> int:
+        """
+        删除已经不存在的文件的记录
+        :return: 删除的记录数
+        """
+        stale = [path for (path,) in self.conn.execute('SELECT path FROM hashes') if path not in existing_paths]
+        self.conn.executemany('DELETE FROM hashes WHERE path = ?', [(path,) for path in stale])
+        self.conn.execute('DELETE FROM indexed WHERE path NOT IN (SELECT path FROM hashes)')
+        self.conn.commit()
+        return len(stale)
+
+    def get_indexed(self) -> dict[str, str]:
+        """
+        返回已经加入相似度索引并查询过的文件，path: pHash
+        """
+        return dict(self.conn.execute('SELECT path, phash FROM indexed'))
+
+    def mark_indexed(self, phash_db: dict[str, str]):
+        """
+        记录这些文件已经加入相似度索引并查询过，下次增量查询时跳过
+        """
+        self.conn.executemany('INSERT OR REPLACE INTO indexed (path, phash) VALUES (?, ?)', phash_db.items())
+        self.conn.commit()
+
+    def relative_path(self, path: str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def get_verified(self) -> dict[str, tuple[int, float]]:
+        """
+        返回上次 rename.check 检查通过的文件，path: (size, mtime)
+        """
+        return {path: (size, mtime) for path, size, mtime in self.conn.execute('SELECT path, size, mtime FROM verified')}
+
+    def put_verified(self, files: list[tuple[str, int, float]]):
+        """
+        记录检查通过的文件
+        :param files: [(绝对路径, size, mtime), ...]
+        """
+        self.conn.executemany('INSERT OR REPLACE INTO verified (path, size, mtime) VALUES (?, ?, ?)',
+                              [(self.relative_path(path), size, mtime) for path, size, mtime in files])
+        self.conn.commit()
+
+    def get_processed(self, kind: str) -> dict[str, tuple[int, float]]:
+        """
+        返回某个处理步骤（如 'webp'）已经处理过、不需要再处理的文件，path: (size, mtime)
+        """
+        return {path: (size, mtime) for path, size, mtime in
+                self.conn.execute('SELECT path, size, mtime FROM processed WHERE kind = ?', (kind,))}
+
+    def put_processed(self, kind: str, files: list[tuple[str, int, float]]):
+        """
+        :param files: [(绝对路径, size, mtime), ...]
+        """
+        self.conn.executemany('INSERT OR REPLACE INTO processed (kind, path, size, mtime) VALUES (?, ?, ?, ?)',
+                              [(kind, self.relative_path(path), size, mtime) for path, size, mtime in files])
+        self.conn.commit()
+
+    def get_live_photos(self, paths: list[str]) -> dict[str, tuple[str, str, int, float, bool]]:
+        """
+        返回记录过 ContentIdentifier 的文件，绝对路径（和传入的一致）: (UUID, 'image' 或 'video', size, mtime, 是否已经重命名)
+        """
+        relative_paths = {self.relative_path(path): path for path in paths}
+        records = {}
+        keys = list(relative_paths)
+        # SQLite 默认最多 999 个参数
+        for i in range(0, len(keys), 900):
+            chunk = keys[i:i + 900]
+            placeholders = ','.join('?' * len(chunk))
+            for path, uuid, media, size, mtime, renamed in self.conn.execute(
+                    f'SELECT path, uuid, media, size, mtime, renamed FROM live_photos WHERE path IN ({placeholders})', chunk):
+                records[relative_paths[path]] = (uuid, media, size, mtime, bool(renamed))
+        return records
+
+    def find_live_photos(self, uuid: str) -> list[tuple[str, str, bool]]:
+        """
+        返回 UUID 相同的文件，[(绝对路径, 'image' 或 'video', 是否已经重命名), ...]
+        """
+        return [(os.path.join(self.root, path), media, bool(renamed)) for path, media, renamed in
+                self.conn.execute('SELECT path, media, renamed FROM live_photos WHERE uuid = ?', (uuid,))]
+
+    def put_live_photos(self, files: list[tuple[str, str, str, int, float]]):
+        """
+        记录还没有配对的 live 图文件
+        :param files: [(绝对路径, UUID, 'image' 或 'video', size, mtime), ...]
+        """
+        self.conn.executemany('INSERT OR REPLACE INTO live_photos (path, uuid, media, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                              [(self.relative_path(path), uuid, media, size, mtime) for path, uuid, media, size, mtime in files])
+        self.conn.commit()
+
+    def move_live_photos(self, moves: list[tuple[str, str]]):
+        """
+        rename 移动文件后更新路径，并标记为已经重命名，之后导入的另一半使用它的文件名
+        :param moves: [(原绝对路径, 新绝对路径), ...]，不在表中的文件忽略
+        """
+        self.conn.executemany('UPDATE live_photos SET path = ?, renamed = 1 WHERE path = ?',
+                              [(self.relative_path(dst), self.relative_path(src)) for src, dst in moves])
+        self.conn.commit()
+
+    def remove_live_photos(self, paths: list[str]):
+        """
+        删除已经配对完成或已经不存在的文件的记录
+        """
+        self.conn.executemany('DELETE FROM live_photos WHERE path = ?', [(self.relative_path(path),) for path in paths])
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    @staticmethod
+    def _group_key(paths: list[str]) -> str:
+        return '\n'.join(sorted(paths))
+
+    def add_kept_group(self, paths: list[str]):
+        """
+        记录用户选择不删除的一组相似图片
+        """
+        self.conn.execute('INSERT OR REPLACE INTO kept_similar (group_key, paths) VALUES (?, ?)',
+                          (self._group_key(paths), json.dumps(sorted(paths), ensure_ascii=False)))
+        self.conn.commit()
+
+    def kept_groups(self) -> list[set[str]]:
+        return [set(json.loads(paths)) for (paths,) in self.conn.execute('SELECT paths FROM kept_similar')]
+
+    def get_meta(self, key: str) -> str | None:
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def import_json_cache(self, cache_file: str, root: str, fast_flag: str = ':fast') -> int:
+        """
+        一次性导入旧的 cache.json，导入过的文件不会重复导入
+        :param cache_file: cache.json 路径
+        :param root: cache.json 中相对路径的根文件夹
+        :param fast_flag: 旧缓存中快速解码 pHash 的后缀标记
+        :return: 导入的记录数
+        """
+        if not os.path.exists(cache_file) or self.get_meta(f'imported:{cache_file}') is not None:
+            return 0
+
+        with open(cache_file, 'r') as f:
+            cache: dict[str, str] = json.load(f)
+
+        records = []
+        for relative_path, phash in cache.items():
+            try:
+                stat = os.stat(os.path.join(root, relative_path))
+            except FileNotFoundError:
+                continue  # 文件已经被删除，不导入
+            algorithm = 'phash'
+            if phash.endswith(fast_flag):
+                phash = phash[:-len(fast_flag)]
+                algorithm = 'phash_fast'
+            records.append(HashRecord(relative_path, stat.st_size, stat.st_mtime, phash, algorithm, HASH_VERSION))
+
+        self.put_many(records)
+        self.set_meta(f'imported:{cache_file}', str(len(records)))
+        self.commit()
+        print(f'Imported {len(records)} hashes from {cache_file}')
+        return len(records)
@@ -0,0 +1,122 @@
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Stats:
+    """
+    各阶段（scan、metadata、decode、hash、index_insert、query、move 等）的处理数量和耗时
+    线程安全，进程池中的耗时由调用方汇总后 add
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts: dict[str, int] = defaultdict(int)
+            self.seconds: dict[str, float] = defaultdict(float)
+            self.started = datetime.now()
+            self._start = time.perf_counter()
+
+    def add(self, stage: str, count: int = 0, seconds: float = 0.0):
+        with self._lock:
+            self.counts[stage] += count
+            self.seconds[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage: str, count: int = 0):
+        """
+        with stats.timer('query', len(entries)): ...
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, count, time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {}
+            for stage in sorted(self.counts.keys() | self.seconds.keys()):
+                count, seconds = self.counts[stage], self.seconds[stage]
+                stages[stage] = {'count': count, 'seconds': round(seconds, 3),
+                                 'per_second': round(count / seconds, 1) if seconds > 0 else None}
+            return {'started': self.started.isoformat(timespec='seconds'),
+                    'elapsed': round(time.perf_counter() - self._start, 3),
+                    'stages': stages}
+
+    def save(self, summary_file: str):
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=4)
+        print(f'Stats saved to {summary_file}')
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f'{"stage":<16}{"count":>10}{"seconds":>10}{"per second":>12}')
+        for stage, value in summary['stages'].items():
+            per_second = f'{value["per_second"]:.1f}' if value['per_second'] is not None else '-'
+            print(f'{stage:<16}{value["count"]:>10}{value["seconds"]:>10.2f}{per_second:>12}')
+        print(f'elapsed {summary["elapsed"]:.2f}s')
+
+
+# 全局的统计，各模块直接使用
+stats = Stats()
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+
+class Progress:
+    """
+    单行进度显示，最多每 interval 秒刷新一次，显示速度和剩余时间（total 未知时不显示剩余时间）
+    """
+    def __init__(self, desc: str, total: int = None, interval: float = 0.5, stream=None):
+        self.desc = desc
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.done = 0
+        self._start = time.perf_counter()
+        self._last = 0.0
+        self._width = 0
+
+    def update(self, n: int = 1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self._render(now)
+
+    def _render(self, now: float):
+        elapsed = now - self._start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = f'{self.desc}: {self.done}'
+        if self.total is not None:
+            line += f'/{self.total}'
+            if rate > 0:
+                line += f' ETA {format_duration((self.total - self.done) / rate)}'
+        line += f' {rate:.1f} files/s {format_duration(elapsed)}'
+        # 覆盖上一次较长的输出
+        self.stream.write('\r' + line.ljust(self._width))
+        self.stream.flush()
+        self._width = len(line)
+
+    def close(self):
+        self._render(time.perf_counter())
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
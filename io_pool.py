@@ -0,0 +1,242 @@
+import builtins
+import contextlib
+import io
+import nt
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterable
+
+
+# 网络文件系统（SMB/NFS）上每次 scandir、stat、rename 都要等一次往返，同时发出多个请求可以把等待重叠起来
+IO_WORKERS = 16
+
+# 顺序读取整个文件时的缓冲区大小，网络文件系统上一次大块读取比多次小块读取少很多次往返
+READ_BUFFER = 1024 * 1024
+
+
+def list_dir(path: str) -> list[nt.DirEntry]:
+    with os.scandir(path) as entries:
+        return list(entries)
+
+
+def read_bytes(path: str) -> io.BytesIO:
+    """
+    用大缓冲区顺序读取整个文件，Pillow 之后的多次小块读取都在内存中完成
+    """
+    with open(path, 'rb', buffering=READ_BUFFER) as f:
+        return io.BytesIO(f.read())
+
+
+def settle(futures: list[Future]) -> tuple[list, list[tuple[int, Exception]]]:
+    """
+    等待所有 Future 完成，一个失败时不影响收集其他的结果
+    :return: (结果，失败的位置为 None；[(下标, 异常), ...])
+    """
+    results = []
+    errors = []
+    for i, future in enumerate(futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(None)
+            errors.append((i, e))
+    return results, errors
+
+
+def raise_errors(errors: list[tuple[int, Exception]]):
+    """
+    打印所有失败，再抛出第一个异常。依赖的操作失败时后面的操作抛出同一个异常，只打印一次
+    """
+    if not errors:
+        return
+    seen = set()
+    for _, e in errors:
+        if id(e) not in seen:
+            seen.add(id(e))
+            print(f'Error: {e}')
+    print(f'{len(errors)} file operations failed')
+    raise errors[0][1]
+
+
+def _stat_entry(entry: nt.DirEntry):
+    try:
+        entry.stat()
+    except OSError:
+        pass  # 文件已经被删除等，之后调用 stat() 的地方再报错
+
+
+class IOPool:
+    """
+    有界线程池，并发执行文件系统操作，返回结果的顺序和输入一致
+    一个操作失败时，其他操作仍然执行完并收集结果后才抛出异常，已经完成的操作不会丢失
+    第一次使用时才创建线程，import 时不会启动线程（进程池 fork 时也不会复制）
+    """
+    def __init__(self, workers: int = IO_WORKERS):
+        self.workers = workers
+        self._executor: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='io')
+            return self._executor
+
+    def set_workers(self, workers: int):
+        """
+        修改线程数，workers 为 1 时所有操作按顺序执行（用于对比）
+        """
+        self.shutdown()
+        self.workers = workers
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.executor.submit(fn, *args)
+
+    def map(self, fn: Callable, items: Iterable) -> list:
+        """
+        全部完成后才抛出第一个异常，需要部分结果时用 settle
+        """
+        results, errors = settle([self.submit(fn, item) for item in items])
+        raise_errors(errors)
+        return results
+
+    def stat_entries(self, entries: list[nt.DirEntry]):
+        """
+        并发调用 entry.stat()，DirEntry 会缓存结果，之后的 entry.stat() 不再访问文件系统
+        """
+        wait([self.submit(_stat_entry, entry) for entry in entries])
+
+    def exists(self, paths: list[str]) -> list[bool]:
+        return self.map(os.path.exists, paths)
+
+    def makedirs(self, dirs: Iterable[str]):
+        self.map(lambda d: os.makedirs(d, exist_ok=True), dirs)
+
+    def rename_ordered(self, moves: list[tuple[str, str]], rename: Callable[[str, str], None] = None) -> list[Future]:
+        """
+        并发移动文件，涉及相同路径的移动按传入的顺序执行（例如 a -> b 之后的 b -> c 会等 a -> b 完成），其他的同时执行
+        线程池按提交顺序取任务，等待的任务取出时它依赖的任务已经在执行，不会死锁
+        :param rename: 移动文件的函数，默认为 os.rename
+        :return: 和 moves 对应的 Future，结果为 rename 的返回值，依赖的移动失败时后面的移动也失败
+        """
+        rename = rename or os.rename
+        last: dict[str, Future] = {}  # path: 最后一个涉及该路径的移动
+        futures = []
+        for src, dst in moves:
+            depends = [last[path] for path in (src, dst) if path in last]
+            future = self.submit(self._rename_after, depends, rename, src, dst)
+            last[src] = last[dst] = future
+            futures.append(future)
+        return futures
+
+    @staticmethod
+    def _rename_after(depends: list[Future], rename: Callable[[str, str], None], src: str, dst: str):
+        for future in depends:
+            future.result()
+        return rename(src, dst)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+# 全局的线程池，各模块直接使用
+io_pool = IOPool()
+
+
+class _SlowDirEntry:
+    """
+    DirEntry 的代理，第一次 stat() 时等待一次往返，之后和 DirEntry 一样使用缓存
+    is_dir()、is_file() 的结果来自目录列表，不需要等待
+    """
+    def __init__(self, entry: nt.DirEntry, latency: float):
+        self._entry = entry
+        self._latency = latency
+        self._stat = None
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self, *, follow_symlinks: bool = True) -> os.stat_result:
+        if self._stat is None:
+            time.sleep(self._latency)
+            self._stat = self._entry.stat(follow_symlinks=follow_symlinks)
+        return self._stat
+
+    def is_dir(self, *, follow_symlinks: bool = True) -> bool:
+        return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, *, follow_symlinks: bool = True) -> bool:
+        return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self) -> bool:
+        return self._entry.is_symlink()
+
+    def inode(self) -> int:
+        return self._entry.inode()
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def __repr__(self):
+        return f'<SlowDirEntry {self.name!r}>'
+
+
+class _SlowScandir:
+    def __init__(self, entries, latency: float):
+        self._entries = entries
+        self._latency = latency
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> _SlowDirEntry:
+        return _SlowDirEntry(next(self._entries), self._latency)
+
+    def close(self):
+        self._entries.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@contextlib.contextmanager
+def inject_latency(latency: float):
+    """
+    在本机模拟网络文件系统：scandir、stat、listdir、open、rename、replace、remove、mkdir、rmdir 每次调用前等待 latency 秒
+    os.path.exists、os.path.isdir、os.makedirs 内部调用 os.stat、os.mkdir，同样会等待
+    只用于测试和 benchmark，修改的是整个进程的 os 模块
+    """
+    originals = {name: getattr(os, name) for name in
+                 ('stat', 'listdir', 'rename', 'replace', 'remove', 'mkdir', 'rmdir')}
+    scandir = os.scandir
+    open_ = builtins.open
+
+    def slow(func):
+        def wrapper(*args, **kwargs):
+            time.sleep(latency)
+            return func(*args, **kwargs)
+        return wrapper
+
+    def slow_scandir(path='.'):
+        time.sleep(latency)
+        return _SlowScandir(scandir(path), latency)
+
+    for name, func in originals.items():
+        setattr(os, name, slow(func))
+    os.scandir = slow_scandir
+    builtins.open = slow(open_)
+    try:
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(os, name, func)
+        os.scandir = scandir
+        builtins.open = open_
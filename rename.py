@@ -1,17 +1,25 @@
+import json
 import nt
 import os
 import random
 import re
+from collections import deque
+from datetime import datetime
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterable, Self
 
 from PIL import Image
 
 import utils
+from hash_index import HashIndex
+from instrument import stats, Progress
+from io_pool import io_pool, raise_errors, settle
 
 
 def get_media_format(file_entry: nt.DirEntry):
-    """获取文件的媒体格式(后缀)"""
-    return Path(file_entry.path).suffix[1:]
+    """获取文件的媒体格式(后缀)，统一为大写，.heic 和 .HEIC 相同"""
+    return Path(file_entry.path).suffix[1:].upper()
 
 
 def generate_new_file_folder_and_name(folder, file_entry: nt.DirEntry):
@@ -34,7 +42,69 @@ print(Image.EXTENSION)
 unsupported_format = ['HEIF', 'HEIC']
 
 
-def rename(folder, file_entry_map: dict[str, list[nt.DirEntry]]):
+def convert_to_jpg(src_path: str, dst_path: str, atime: float, mtime: float):
+    """
+    将不支持的格式转换为 jpg 并删除原文件，只传路径，可以在进程池中运行
+    """
+    # TODO 转移元数据用 utils.dng_to_jpg 里的方法
+    with Image.open(src_path) as img:
+        exif_data = img.info.get('exif') or b''  # 没有 exif 时 Pillow 不接受 None
+        # 保留 exif 数据
+        img.save(dst_path, exif=exif_data)  # 转换为jpg格式
+    # 设置修改时间为原文件的修改时间
+    os.utime(dst_path, (atime, mtime))
+    os.remove(src_path)
+
+
+class Move:
+    """
+    重命名计划中的一步：把 src 移动到 dst，convert 为 True 时转换为 jpg
+    """
+    def __init__(self, src: str, dst: str, convert: bool = False):
+        self.src = src
+        self.dst = dst
+        self.convert = convert
+
+    def to_dict(self) -> dict:
+        return {'src': self.src, 'dst': self.dst, 'convert': self.convert}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Self:
+        return cls(data['src'], data['dst'], data.get('convert', False))
+
+    def __repr__(self):
+        return f'Move({self.src} -> {self.dst}{", convert" if self.convert else ""})'
+
+
+def target_suffix(file_entry: nt.DirEntry, formats: dict[str, str] = None) -> tuple[str, bool]:
+    """
+    重命名后的后缀，以及是否需要转换为 jpg
+    :param formats: utils.detect_formats 批量判断的结果，不包含该文件时单独读取文件头
+    """
+    suffix = Path(file_entry.path).suffix
+    media_format = get_media_format(file_entry)
+    # 按文件头判断，后缀不是 HEIC 但内容是 HEIC 的文件也需要转换
+    if media_format not in unsupported_format:
+        if formats is not None and file_entry.path in formats:
+            content_format = formats[file_entry.path]
+        else:
+            content_format = utils.detect_format(file_entry)
+        if content_format == 'heif':
+            media_format = 'HEIC'
+    # 如果是不支持的格式，强制转换为 jpg
+    if media_format in unsupported_format:
+        return '.jpg', True
+    return suffix, False
+
+
+def plan_rename(folder, file_entry_map: dict[str, list[nt.DirEntry]]) -> list[Move]:
+    """
+    计算 file_entry_map 中文件的新路径，不移动文件。已经计算过的 UUID 会从 file_entry_map 中删除
+    """
+    moves = []
+    # 整个 batch 一起读取文件头，判断内容是 HEIC 的文件
+    formats = utils.detect_formats([file_entry for file_entry_list in file_entry_map.values() for file_entry in file_entry_list
+                                    if get_media_format(file_entry) not in unsupported_format])
     for content_uuid, file_entry_list in list(file_entry_map.items()):
         if content_uuid != '':
             # 如果有 UUID，且只有一个文件，说明live图没有匹配全，延迟处理，即不被 del
@@ -48,41 +118,330 @@ def rename(folder, file_entry_map: dict[str, list[nt.DirEntry]]):
                 # 如果没有 UUID，直接用 file_entry 生成新的文件夹和文件名
                 new_folder_path, new_name = generate_new_file_folder_and_name(folder, file_entry)
 
-            if not os.path.exists(new_folder_path):
-                os.makedirs(new_folder_path)
-
-            suffix = Path(file_entry.path).suffix
-            media_format = get_media_format(file_entry)
-            # 如果是不支持的格式，强制转换为 jpg
-            if media_format in unsupported_format:
-                suffix = '.jpg'
-
+            suffix, convert = target_suffix(file_entry, formats)
             new_name_with_suffix = new_name + suffix
 
             # 如果文件所在位置和文件名已经符合要求，就不操作
             if (os.path.dirname(file_entry.path) == new_folder_path and file_entry.name[0:25] ==
-                    new_name[0:25] and media_format not in unsupported_format):
+                    new_name[0:25] and not convert):
                 continue
 
-            if media_format not in unsupported_format:
-                os.rename(file_entry.path, os.path.join(new_folder_path, new_name_with_suffix))
-            else:
-                # TODO 转移元数据用 utils.dng_to_jpg 里的方法
-                with Image.open(file_entry.path) as img:
-                    exif_data = img.info.get('exif')
-                # 保留 exif 数据
-                img.save(os.path.join(new_folder_path, new_name_with_suffix), exif=exif_data)  # 转换为jpg格式
-                # 设置修改时间为原文件的修改时间
-                os.utime(os.path.join(new_folder_path, new_name_with_suffix), (file_entry.stat().st_atime, file_entry.stat().st_mtime))
-                os.remove(file_entry.path)
+            moves.append(Move(file_entry.path, os.path.join(new_folder_path, new_name_with_suffix), convert))
 
+        utils.forget_metadata(file_entry_list)
         del file_entry_map[content_uuid]
 
+    return moves
+
+
+def move_file(src: str, dst: str) -> bool:
+    """
+    移动文件，dst 已经存在时不覆盖
+    重放已经执行过的计划时，链式移动（a -> b 之后 c -> a）中 a 的位置已经是 c 的内容，覆盖会丢失文件
+    :return: 是否移动
+    """
+    if os.path.exists(dst):
+        print(f'{dst} already exists, skip {src}')
+        return False
+    os.rename(src, dst)
+    return True
+
+
+def apply_plan(moves: list[Move], root: str, executor: Executor = None, hash_index: HashIndex = None):
+    """
+    执行重命名计划：先一次性创建所有目标文件夹，再移动文件，最后只在涉及到的源文件夹中删除空文件夹
+    可以重复执行：源文件不存在或目标文件已经存在的移动跳过，不会覆盖已有的文件
+    :param root: 根文件夹，删除空文件夹时不会超出也不会删除该文件夹
+    :param executor: 格式转换使用的进程池，为 None 时直接在当前进程转换
+    :param hash_index: 不为 None 时更新 live_photos 表中还没有配对的文件的路径
+    """
+    # 重放中断的计划时，已经移动过的文件跳过
+    pending = [move for move, exists in zip(moves, io_pool.exists([move.src for move in moves])) if exists]
+    if len(pending) != len(moves):
+        print(f'{len(moves) - len(pending)} files already moved, skipped')
+
+    io_pool.makedirs({os.path.dirname(move.dst) for move in pending})
+
+    done: list[Move] = []  # 实际执行的移动
+    progress = Progress('move', len(pending))
+    renames = [move for move in pending if not move.convert]
+    converts = [move for move in pending if move.convert]
+    try:
+        # 移动在 io_pool 中并发执行，涉及相同路径的移动仍按计划中的顺序执行
+        # 有操作失败时，其他操作仍然执行完并记录，最后再抛出异常
+        with stats.timer('move', len(renames)):
+            moved, errors = settle(io_pool.rename_ordered([(move.src, move.dst) for move in renames], move_file))
+        done.extend(move for move, ok in zip(renames, moved) if ok)
+        progress.update(len(renames))
+
+        converted, convert_errors = _convert(converts, progress, executor)
+        done.extend(move for move, ok in zip(converts, converted) if ok)
+        errors += [(len(renames) + i, e) for i, e in convert_errors]
+    finally:
+        progress.close()
+        if hash_index is not None:
+            hash_index.move_live_photos([(move.src, move.dst) for move in done])
+        utils.del_empty_dirs({os.path.dirname(move.src) for move in done}, root)
+    raise_errors(errors)
+
+
+def _convert(converts: list[Move], progress: Progress, executor: Executor = None) -> tuple[list[bool], list[tuple[int, Exception]]]:
+    """
+    执行格式转换，目标文件已经存在时跳过，一个转换失败时其他的仍然执行完
+    :param executor: 为 None 时直接在当前进程转换
+    :return: ([是否转换], [(下标, 异常), ...])
+    """
+    futures = []
+    skipped = set()
+    submitted = 0
+    for i, move in enumerate(converts):
+        future = Future()
+        if os.path.exists(move.dst):
+            print(f'{move.dst} already exists, skip {move.src}')
+            skipped.add(i)
+            future.set_result(None)
+        else:
+            stat = os.stat(move.src)
+            args = (move.src, move.dst, stat.st_atime, stat.st_mtime)
+            if executor is None:
+                try:
+                    with stats.timer('convert', 1):
+                        convert_to_jpg(*args)
+                    future.set_result(None)
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                future = executor.submit(convert_to_jpg, *args)
+                submitted += 1
+        future.add_done_callback(lambda _: progress.update())
+        futures.append(future)
+    # 进程池中的转换只统计等待的时间
+    with stats.timer('convert', submitted):
+        _, errors = settle(futures)
+    failed = {i for i, _ in errors}
+    return [i not in skipped and i not in failed for i in range(len(converts))], errors
+
+
+def media_kind(file_entry: nt.DirEntry) -> str:
+    return 'video' if file_entry.name.endswith(utils.video_suffix) else 'image'
+
+
+class LivePhotoPairer:
+    """
+    按 ContentIdentifier 配对 live 图的图片和视频，UUID 记录在 hash_index 的 live_photos 表中：
+    - 配对完成的文件所在的 batch 处理完就交给 plan_rename，内存中只保留还没有配对的文件
+    - 没有配对的文件留在表中，下次运行时不需要重新读取 UUID（只有视频的 live 图不需要读取任何元数据）
+    - 另一半已经在之前的运行中重命名过时，直接使用它的文件名
+    """
+    def __init__(self, folder, hash_index: HashIndex):
+        self.folder = folder
+        self.hash_index = hash_index
+        self.pending: dict[str, list[nt.DirEntry]] = {}  # 本次运行中还没有配对的文件，UUID: [entry, ...]
+        self.paired: dict[str, list[str]] = {}  # 本次运行中已经配对的 UUID: [文件名, ...]，再出现同一个 UUID 时报错
+
+    def cached_uuids(self, batch: list[nt.DirEntry]) -> dict[str, str]:
+        """
+        表中记录过且大小、修改时间没有变化的文件，path: UUID
+        """
+        records = self.hash_index.get_live_photos([file_entry.path for file_entry in batch])
+        cached = {}
+        for file_entry in batch:
+            record = records.get(file_entry.path)
+            if record is not None and record[2:4] == (file_entry.stat().st_size, file_entry.stat().st_mtime):
+                cached[file_entry.path] = record[0]
+        return cached
+
+    def need_metadata(self, batch: list[nt.DirEntry]) -> list[nt.DirEntry]:
+        """
+        prefetch_metadata 中只需要读取 UUID 没有记录过的文件
+        """
+        cached = self.cached_uuids(batch)
+        return [file_entry for file_entry in batch if file_entry.path not in cached]
+
+    def _in_folder(self, path: str) -> bool:
+        folder_path = os.path.abspath(self.folder.path)
+        return os.path.commonpath([os.path.abspath(path), folder_path]) == folder_path
+
+    @staticmethod
+    def multiple_files_error(content_uuid: str, names: list[str]) -> ValueError:
+        print(f'Error: {content_uuid} has {len(names)} files')
+        for name in names:
+            print(name)
+        return ValueError('Error: UUID has multiple files')
+
+    def _renamed_partner(self, content_uuid: str, file_entry: nt.DirEntry) -> str | None:
+        """
+        之前的运行中已经重命名的另一半，没有时返回 None
+        """
+        stale = []
+        partner = None
+        for path, media, renamed in self.hash_index.find_live_photos(content_uuid):
+            if not renamed or media == media_kind(file_entry) or not self._in_folder(path):
+                continue
+            if not os.path.exists(path):
+                stale.append(path)  # 已经被删除
+                continue
+            partner = path
+            break
+        if stale:
+            self.hash_index.remove_live_photos(stale)
+        return partner
+
+    def add_batch(self, batch: list[nt.DirEntry]) -> tuple[dict[str, list[nt.DirEntry]], list[Move]]:
+        """
+        :return: (可以立即交给 plan_rename 的 file_entry_map，跟随已经重命名的另一半命名的 Move)
+        """
+        cached = self.cached_uuids(batch)
+        utils.read_metadata_batch([file_entry for file_entry in batch if file_entry.path not in cached])
+
+        file_entry_map = {
+            '': []  # files without UUID
+        }  # UUID: [file1, file2, ...]
+        moves = []
+        new_records = []
+        done = []  # 配对完成的文件，从表中删除
+
+        for file_entry in batch:
+            content_uuid = cached[file_entry.path] if file_entry.path in cached else utils.get_content_uuid(file_entry)
+            if not content_uuid:
+                file_entry_map[''].append(file_entry)
+                continue
+            if file_entry.path not in cached:
+                stat = file_entry.stat()
+                new_records.append((file_entry.path, content_uuid, media_kind(file_entry), stat.st_size, stat.st_mtime))
+
+            # 理论上每个 UUID 最多有两个文件，一个是图片，一个是视频
+            if content_uuid in self.paired:
+                # 已经配对完成，第三个文件
+                raise self.multiple_files_error(content_uuid, self.paired[content_uuid] + [file_entry.name])
+
+            if content_uuid in self.pending:
+                files = self.pending.pop(content_uuid)
+                files.append(file_entry)
+                if not utils.has_unique_suffix(files):
+                    raise self.multiple_files_error(content_uuid, [file.name for file in files])
+                file_entry_map[content_uuid] = files
+                self.paired[content_uuid] = [file.name for file in files]
+                done.extend(file.path for file in files)
+                continue
+
+            partner = self._renamed_partner(content_uuid, file_entry)
+            if partner is not None:
+                suffix, convert = target_suffix(file_entry)
+                dst = os.path.join(os.path.dirname(partner), Path(partner).stem + suffix)
+                if not os.path.exists(dst):
+                    moves.append(Move(file_entry.path, dst, convert))
+                    self.paired[content_uuid] = [os.path.basename(partner), file_entry.name]
+                    done.extend([file_entry.path, partner])
+                    continue
+                print(f'Error: {dst} already exists')
+            self.pending[content_uuid] = [file_entry]
+
+        self.hash_index.put_live_photos(new_records)
+        self.hash_index.remove_live_photos(done)
+        # UUID 来自表中记录的图片还需要读取拍摄时间，整个 batch 一起读取
+        utils.read_metadata_batch([file_entry for files in file_entry_map.values() for file_entry in files
+                                   if media_kind(file_entry) == 'image'])
+        return file_entry_map, moves
+
+    def finish(self) -> tuple[dict[str, list[nt.DirEntry]], list[str]]:
+        """
+        文件夹扫描完后还没有配对的文件：图片当作普通图片重命名（表中的记录保留，之后导入的视频使用它的文件名），
+        视频说明图片丢失或还没有导入，不移动，下次运行时再配对
+        :return: (file_entry_map，没有图片的视频)
+        """
+        unprocessed_files = []
+        error_files = []
+        if self.pending:
+            print(f'Error: {len(self.pending)} UUIDs left')
+        for content_uuid, files in self.pending.items():
+            print(f'UUID: {content_uuid}, files: {len(files)}')
+            if media_kind(files[0]) == 'video':
+                print(files[0].name)
+                error_files.append(files[0].name)
+            else:
+                unprocessed_files.extend(files)
+        self.pending.clear()
+
+        utils.read_metadata_batch([file_entry for file_entry in unprocessed_files])
+        return {'': unprocessed_files}, error_files
+
+
+def rename(folder, file_entry_map: dict[str, list[nt.DirEntry]], executor: Executor = None):
+    """
+    计算并立即执行 file_entry_map 中文件的重命名
+    """
+    apply_plan(plan_rename(folder, file_entry_map), folder.path, executor)
+
+
+def save_plan(moves: list[Move], plan_file: str):
+    with open(plan_file, 'w', encoding='utf-8') as f:
+        json.dump([move.to_dict() for move in moves], f, ensure_ascii=False, indent=4)
+    print(f'Plan saved to {plan_file}, {len(moves)} moves')
+
+
+def load_plan(plan_file: str) -> list[Move]:
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        return [Move.from_dict(data) for data in json.load(f)]
+
+
+def prefetch_metadata(batches: Iterable[list[nt.DirEntry]], executor: Executor, chunk_size: int = 16,
+                      need: Callable[[list[nt.DirEntry]], list[nt.DirEntry]] = None):
+    """
+    在线程池中提前读取下一个 batch 的元数据，当前 batch 重命名时下一个 batch 的元数据已经在读取
+    每个线程使用自己的 exiftool 进程，一个 batch 拆成多个 chunk 并发读取
+    :param need: 返回 batch 中需要读取的文件，为 None 时读取全部
+    """
+    pending = deque()
+    for batch in batches:
+        entries = need(batch) if need is not None else batch
+        pending.append((batch, [executor.submit(utils.read_metadata_batch, chunk) for chunk in utils.batched(entries, chunk_size)]))
+        if len(pending) > 1:
+            ready_batch, futures = pending.popleft()
+            for future in futures:
+                future.result()
+            yield ready_batch
+
+    while pending:
+        ready_batch, futures = pending.popleft()
+        for future in futures:
+            future.result()
+        yield ready_batch
+
+
+# 文件名格式为 YYYYMMDD_HHMMSS_TZ_DAY_RND
+name_pattern = re.compile(r'^(\d{8}_\d{6}_[+-]\d{4})_([A-Za-z]+)_')
+
+
+def parse_name_time(name: str) -> datetime | None:
+    """
+    从 rename 生成的文件名中解析时间，文件名不符合格式时返回 None
+    """
+    match = name_pattern.match(name)
+    if not match:
+        return None
+    try:
+        dt = datetime.strptime(match.group(1), '%Y%m%d_%H%M%S_%z')
+    except ValueError:
+        return None
+    # 星期和日期不一致，说明文件名被改过
+    if dt.strftime('%a') != match.group(2):
+        return None
+    return dt
+
 
 # 仅仅检查文件所在文件夹是否符合其last modified time，没有检查live图片的jpg和mov是否一一对应
-def check(folder):
-    print(f'Checking {folder.path}...')
+def find_violations(folder, fast: bool = True, hash_index: HashIndex = None) -> list[str]:
+    """
+    检查 year/month 文件夹下的文件，返回所有不符合要求的文件
+    :param fast: 根据文件名中的时间检查所在文件夹，只有上次检查后文件名、大小、修改时间变化过的文件才读取 EXIF 检查文件名
+    :param hash_index: 记录上次检查通过的文件，为 None 时所有文件都读取 EXIF
+    """
     suffix = ('.jpg', '.JPG', '.png', '.PNG', '.heic', '.HEIC')
+    violations = []
+
+    verified = hash_index.get_verified() if fast and hash_index is not None else {}
+    to_verify: list[nt.DirEntry] = []  # 需要读取 EXIF 检查的文件
 
     with os.scandir(folder.path) as years:
         for year_entry in years:
@@ -99,12 +458,8 @@ def check(folder):
                             file_path = file_entry.path
 
                             if file_entry.is_dir():  # 发现子文件夹
-                                print(f'{file_path} is a folder')
-                                return False
-
-                            # 获取修改时间
-                            dt = utils.get_media_time(file_entry)
-                            dt = folder.convert_to_zone(dt)
+                                violations.append(f'{file_path} is a folder')
+                                continue
 
                             # 检查文件后缀
                             if not file_entry.name.endswith(suffix):
@@ -113,79 +468,109 @@ def check(folder):
                             # 获取文件格式
                             img_format = get_media_format(file_entry)
                             if img_format in unsupported_format:
-                                print(f'{file_path} is not supported')
-                                return False
+                                violations.append(f'{file_path} is not supported')
+                                continue
+
+                            # 根据文件名中的时间检查所在的 year/month 文件夹
+                            dt = parse_name_time(file_entry.name)
+                            if dt is None:
+                                violations.append(f'{file_path} has no valid time in name')
+                                continue
+                            if (year_entry.name, month_entry.name) != (dt.strftime('%Y'), dt.strftime('%m')):
+                                violations.append(f'{file_path} is not correct, expected {dt.strftime("%Y")}/{dt.strftime("%m")}')
+                                continue
+
+                            stat = file_entry.stat()
+                            if hash_index is not None and verified.get(hash_index.relative_path(file_path)) == (stat.st_size, stat.st_mtime):
+                                continue
+                            to_verify.append(file_entry)
+
+    # 检查文件名和 EXIF 中的时间是否一致，每个 batch 只读取一次 EXIF
+    print(f'{len(to_verify)} files need to be verified with EXIF')
+    progress = Progress('check', len(to_verify))
+    for batch in utils.batched(to_verify, 64):
+        utils.read_metadata_batch(batch)
+        passed = []
+        for file_entry in batch:
+            dt = utils.get_media_time(file_entry)
+            dt = folder.convert_to_zone(dt)
+            expected_prefix = f'{dt.strftime("%Y%m%d_%H%M%S_%z")}_{dt.strftime("%a")}'
+            if not file_entry.name.startswith(expected_prefix):
+                violations.append(f'{file_entry.path} is not correct, expected prefix {expected_prefix}')
+            else:
+                passed.append(file_entry)
+        utils.forget_metadata(batch)
 
-                            # 检查文件路径和命名是否符合规范
-                            expected_dir = os.path.join(folder.path, year_entry.name, month_entry.name)
-                            expected_prefix = f'{dt.strftime("%Y%m%d_%H%M%S_%z")}_{dt.strftime("%a")}'
+        if hash_index is not None:
+            hash_index.put_verified([(file_entry.path, file_entry.stat().st_size, file_entry.stat().st_mtime)
+                                     for file_entry in passed])
+        progress.update(len(batch))
+    progress.close()
 
-                            if os.path.dirname(file_path) != expected_dir or not file_entry.name.startswith(expected_prefix):
-                                print(f'{file_path} is not correct, expected {expected_dir}/{expected_prefix}')
-                                return False
+    return violations
 
-    return True  # 所有文件都符合要求
+
+def check(folder, fast: bool = True, hash_index: HashIndex = None) -> bool:
+    """
+    打印所有不符合要求的文件，全部符合时返回 True
+    """
+    print(f'Checking {folder.path}...')
+    violations = find_violations(folder, fast, hash_index)
+    for violation in violations:
+        print(violation)
+    return len(violations) == 0  # 所有文件都符合要求
 
 
 if __name__ == '__main__':
-    folders = utils.load_config('folders.yaml')
-    for folder in folders:
-        print(f'path: {folder.path}')
-        print(f'len: {len(folder.zones)}, timezone: {folder.zones_str()}')
-        file_entry_map = {
-            '': []  # files without UUID
-        }  # UUID: [file1, file2, ...]
-        batch_num = 0
-        for batch in utils.load_media_batch(folder.path, 64, media_type=utils.MediaType.all_media(), all_files=False):
-            print(f'batch {batch_num}, size {len(batch)}')
-            file_entry_map_batch = utils.get_file_entry_map(batch)
-            for uuid, files in file_entry_map_batch.items():
-                if uuid not in file_entry_map:
-                    file_entry_map[uuid] = []
-                file_entry_map[uuid].extend(files)
-                # 理论上每个 UUID 最多有两个文件，一个是图片，一个是视频
-                if uuid != '' and (len(file_entry_map[uuid]) > 2 or not utils.has_unique_suffix(file_entry_map[uuid])):
-                    print(f'Error: {uuid} has {len(file_entry_map[uuid])} files')
-                    for file in file_entry_map[uuid]:
-                        print(file.name)
-                    raise ValueError('Error: UUID has multiple files')
-            rename(folder, file_entry_map)
-            utils.del_empty_folder(folder.path)
-            batch_num += 1
-
-        # 如果还有文件没有处理，说明有 UUID 的图片或者视频没有匹配到
-        error_files = []
-        unprocessed_files = []
+    dry_run = False  # 只生成重命名计划，不移动文件
 
-        if len(file_entry_map.keys()) > 1 or (len(file_entry_map.keys()) == 1 and '' not in file_entry_map):
-            print(f'Error: {len(file_entry_map.keys())} UUIDs left')
-            for uuid, files in list(file_entry_map.items()):
-                if uuid == '':
-                    raise ValueError("Error: Image without UUID should not be left")
-                print(f'UUID: {uuid}, files: {len(files)}')
-                # 如果只有一个文件，且是视频，说明 live photo 的图片或者视频丢失
-                if len(files) == 1:
-                    # 如果是视频，说明 live photo 的图片丢失，严重错误
-                    if files[0].name.endswith(utils.video_suffix):
-                        print(files[0].name)
-                        error_files.append(files[0].name)
-                    # 如果是图片，说明有图片没有匹配到视频，轻微错误，把这些图片放 file_entry_map[''] 里当作普通图片处理
-                    else:
-                        unprocessed_files.extend(files)
-                    del file_entry_map[uuid]
-                else:
-                    # 此时已经处于完成匹配阶段，不可能存在 UUID 有多个文件的情况，因为这代表了未匹配
-                    print(f'Error: {uuid} has {len(files)} files')
-                    for file in files:
-                        print(file.name)
-                    raise ValueError('Error: UUID has multiple files')
-            file_entry_map[''] = unprocessed_files
-            print(unprocessed_files)
-            rename(folder, file_entry_map)
-
-        if len(error_files) > 0:
-            print(f'Error: {len(error_files)} videos are missing')
-            for file in error_files:
-                print(file)
-
-        print(check(folder))
\ No newline at end of file
+    folders = utils.load_config('folders.yaml')
+    # 上次中断时留下的计划直接重放，不需要重新读取 EXIF
+    plan_file = os.path.join(folders.path, 'rename_plan.json')
+
+    with HashIndex(os.path.join(folders.path, 'cache.db')) as hash_index:
+        if os.path.exists(plan_file):
+            print(f'Replaying {plan_file}')
+            moves = load_plan(plan_file)
+        else:
+            moves: list[Move] = []
+            # 元数据在线程池中并发读取，live 图配对仍在主线程按顺序执行
+            metadata_pool = ThreadPoolExecutor(max_workers=4)
+            for folder in folders:
+                print(f'path: {folder.path}')
+                print(f'len: {len(folder.zones)}, timezone: {folder.zones_str()}')
+                # 没有配对的 live 图记录在 cache.db 中，跨 batch、跨运行配对
+                pairer = LivePhotoPairer(folder, hash_index)
+                progress = Progress('plan')
+                batches = utils.load_media_batch(folder.path, 64, media_type=utils.MediaType.all_media(), all_files=False)
+                for batch in prefetch_metadata(batches, metadata_pool, need=pairer.need_metadata):
+                    file_entry_map, follow_moves = pairer.add_batch(batch)
+                    with stats.timer('plan', len(batch)):
+                        moves.extend(follow_moves)
+                        moves.extend(plan_rename(folder, file_entry_map))
+                    progress.update(len(batch))
+                progress.close()
+
+                # 还没有配对的图片当作普通图片处理，视频留到下次运行
+                file_entry_map, error_files = pairer.finish()
+                moves.extend(plan_rename(folder, file_entry_map))
+
+                if len(error_files) > 0:
+                    print(f'Error: {len(error_files)} videos are missing')
+                    for file in error_files:
+                        print(file)
+            metadata_pool.shutdown()
+
+            save_plan(moves, plan_file)
+
+        if not dry_run:
+            # 格式转换在进程池中执行，移动文件在 io_pool 中并发执行（涉及相同路径的移动按计划中的顺序），空文件夹只在最后删除一次
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as convert_pool:
+                apply_plan(moves, folders.path, convert_pool, hash_index)
+            os.remove(plan_file)
+
+        for folder in folders:
+            print(check(folder, fast=True, hash_index=hash_index))
+
+    stats.print_summary()
+    stats.save(os.path.join(folders.path, 'stats_rename.json'))
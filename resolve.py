@@ -0,0 +1,219 @@
+import json
+import nt
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Self
+
+import utils
+from io_pool import io_pool
+
+
+class KeepPolicy(Enum):
+    """
+    自动选择相似组中保留哪张图片的规则，多个规则按顺序比较，前一个规则相同时才比较下一个
+    """
+    PIXELS = 'pixels'  # 像素数最多（宽 * 高 * 通道数）
+    FILE_SIZE = 'file_size'  # 文件最大
+    OLDEST = 'oldest'  # 拍摄时间最早
+    FORMAT = 'format'  # 格式在 format_preference 中最靠前
+
+
+default_policies = [KeepPolicy.PIXELS, KeepPolicy.FILE_SIZE, KeepPolicy.OLDEST]
+
+# 偏好的格式（utils.sniff_format 的结果），越靠前越优先，不在列表中的排在最后
+format_preference = ['png', 'heif', 'jpeg', 'webp']
+
+trash_folder = '.trash'
+
+
+class MediaInfo:
+    """
+    选择保留图片时用到的信息，由 collect_info 一次性获取
+    """
+    def __init__(self, path: str, pixels: int, size: int, timestamp: float, format: str):
+        self.path = path
+        self.pixels = pixels
+        self.size = size
+        self.timestamp = timestamp  # 拍摄时间，没有 EXIF 时为修改时间
+        self.format = format
+
+    def to_dict(self) -> dict:
+        return {'pixels': self.pixels, 'size': self.size, 'timestamp': self.timestamp, 'format': self.format}
+
+    def __repr__(self):
+        return f'MediaInfo({self.path}, {self.pixels}px, {utils.file_size_to_str(self.size)}, {self.format})'
+
+
+def _pixels(entry: nt.DirEntry) -> int:
+    try:
+        return utils.get_image_raw_size(entry)
+    except OSError as e:
+        print(f'Error: {e}')
+        return 0
+
+
+def collect_info(entries: list[nt.DirEntry], workers: int = 8) -> dict[str, MediaInfo]:
+    """
+    一次性获取所有图片的像素数、文件大小、拍摄时间和格式，文件头在 io_pool 中、EXIF 在 workers 个 exiftool 进程中批量并发读取
+    :param workers: 读取 EXIF 的线程数，每个线程一个 exiftool 进程
+    :return: path: MediaInfo
+    """
+    formats = utils.detect_formats(entries)
+    pixels = io_pool.map(_pixels, entries)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # 每个线程有自己的 exiftool 进程，每次读取一个 batch
+        for _ in executor.map(utils.read_metadata_batch, utils.batched(entries, 64)):
+            pass
+
+    infos = {}
+    for entry, pixel_count in zip(entries, pixels):
+        timestamp = utils.get_image_time(entry).timestamp()
+        infos[entry.path] = MediaInfo(entry.path, pixel_count, entry.stat().st_size, timestamp, formats[entry.path])
+    return infos
+
+
+def _sort_key(info: MediaInfo, policies: list[KeepPolicy], preference: list[str]) -> tuple:
+    """
+    越小越优先保留
+    """
+    key = []
+    for policy in policies:
+        if policy == KeepPolicy.PIXELS:
+            key.append(-info.pixels)
+        elif policy == KeepPolicy.FILE_SIZE:
+            key.append(-info.size)
+        elif policy == KeepPolicy.OLDEST:
+            key.append(info.timestamp)
+        elif policy == KeepPolicy.FORMAT:
+            key.append(preference.index(info.format) if info.format in preference else len(preference))
+    return tuple(key)
+
+
+class Decision:
+    """
+    一个相似组的处理结果：保留 keep，删除 remove
+    trashed 为实际移动到回收文件夹的文件 [(原路径, 回收路径), ...]，用于撤销
+    """
+    def __init__(self, keep: str, remove: list[str], infos: dict[str, dict] = None, trashed: list[tuple[str, str]] = None):
+        self.keep = keep
+        self.remove = remove
+        self.infos = infos or {}  # path: MediaInfo.to_dict()，只用于查看
+        self.trashed = trashed or []
+
+    def to_dict(self) -> dict:
+        return {'keep': self.keep, 'remove': self.remove, 'infos': self.infos, 'trashed': self.trashed}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Self:
+        return cls(data['keep'], data['remove'], data.get('infos'), [tuple(t) for t in data.get('trashed', [])])
+
+    def __repr__(self):
+        return f'Decision(keep {self.keep}, remove {len(self.remove)})'
+
+
+def resolve_groups(similar_groups: list[list[tuple[nt.DirEntry, int]]], policies: list[KeepPolicy] = None,
+                   preference: list[str] = None, workers: int = 8) -> list[Decision]:
+    """
+    不需要交互，按规则为每个相似组选择保留的图片
+    :param similar_groups: query_similar_images 的结果
+    :param policies: 保留规则，按顺序比较，全部相同时保留组内第一张
+    :param preference: KeepPolicy.FORMAT 使用的格式顺序
+    """
+    policies = policies or default_policies
+    preference = preference or format_preference
+
+    # 所有组的图片一起读取，而不是每组分别读取
+    entries = list({entry.path: entry for group in similar_groups for entry, _ in group}.values())
+    infos = collect_info(entries, workers)
+
+    decisions = []
+    for group in similar_groups:
+        paths = [entry.path for entry, _ in group]
+        # sorted 是稳定的，规则都相同时保留原来的顺序
+        ranked = sorted(paths, key=lambda path: _sort_key(infos[path], policies, preference))
+        decisions.append(Decision(ranked[0], ranked[1:], {path: infos[path].to_dict() for path in paths}))
+    return decisions
+
+
+def save_decisions(decisions: list[Decision], decision_file: str):
+    with open(decision_file, 'w', encoding='utf-8') as f:
+        json.dump([decision.to_dict() for decision in decisions], f, ensure_ascii=False, indent=4)
+    print(f'Decisions saved to {decision_file}, {len(decisions)} groups')
+
+
+def load_decisions(decision_file: str) -> list[Decision]:
+    with open(decision_file, 'r', encoding='utf-8') as f:
+        return [Decision.from_dict(data) for data in json.load(f)]
+
+
+def add_decisions(decisions: list[Decision], decision_file: str):
+    """
+    把新的结果合并到已有的 decision_file 中，而不是覆盖：
+    已有的记录中移动过文件的组（撤销时需要 trashed）和还没有执行的组都保留，同一组图片不重复添加
+    """
+    existing = load_decisions(decision_file) if os.path.exists(decision_file) else []
+    paths = [path for decision in existing for path in decision.remove]
+    exists = dict(zip(paths, io_pool.exists(paths)))
+    # 直接删除（不经过回收文件夹）且已经执行完的组不再需要
+    existing = [decision for decision in existing if decision.trashed or any(exists[path] for path in decision.remove)]
+
+    def group_key(decision: Decision) -> frozenset[str]:
+        return frozenset([decision.keep, *decision.remove])
+
+    known = {group_key(decision) for decision in existing}
+    added = [decision for decision in decisions if group_key(decision) not in known]
+    print(f'{len(existing)} groups kept from {decision_file}, {len(added)} added')
+    save_decisions(existing + added, decision_file)
+
+
+def apply_decisions(decisions: list[Decision], root: str, trash: bool = True):
+    """
+    删除每组中不保留的图片及其同名文件
+    :param root: 根文件夹，回收文件夹为 root/.trash，按原来的相对路径存放
+    :param trash: True 时移动到回收文件夹，可以用 rollback_decisions 撤销；False 时直接删除
+    """
+    # 已经删除的文件跳过，中断后可以重新执行
+    owner = {path: decision for decision in decisions for path in decision.remove if os.path.exists(path)}
+
+    def record(path: str, src: str, dst: str | None):
+        # 每个文件移动完成时就记录，中途失败时已经移动的文件仍然可以撤销
+        if dst is not None:
+            owner[path].trashed.append((src, dst))
+
+    # 所有组一起删除，每个文件夹只扫描一次
+    utils.del_images(owner.keys(), root=root, trash_folder=os.path.join(root, trash_folder) if trash else None,
+                     keep=[decision.keep for decision in decisions], on_removed=record)
+
+
+def rollback_decisions(decisions: list[Decision], root: str):
+    """
+    把 apply_decisions 移动到回收文件夹的文件移回原来的位置
+    """
+    trash_dirs = set()
+    for decision in decisions:
+        for src, dst in list(decision.trashed):
+            if os.path.exists(dst) and not os.path.exists(src):
+                os.makedirs(os.path.dirname(src), exist_ok=True)
+                print('restore', src)
+                os.replace(dst, src)
+                trash_dirs.add(os.path.dirname(dst))
+                decision.trashed.remove((src, dst))  # 每个文件恢复后就记录，中途失败时不会重复恢复
+    utils.del_empty_dirs(trash_dirs, root)
+
+
+if __name__ == '__main__':
+    folders = utils.load_config('folders.yaml')
+
+    rollback = False  # True 时撤销上次执行的删除
+    decision_file = os.path.join(folders.path, 'similar_decisions.json')
+
+    decisions = load_decisions(decision_file)
+    try:
+        if rollback:
+            rollback_decisions(decisions, folders.path)
+        else:
+            apply_decisions(decisions, folders.path, trash=True)
+    finally:
+        # 保存执行结果，撤销时需要。中途失败时也保存已经完成的部分
+        save_decisions(decisions, decision_file)
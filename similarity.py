@@ -1,48 +1,199 @@
+import io
 import nt
 import os
-import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
 
 import imagehash
+import numpy as np
+import rawpy
+import scipy.fftpack  # 和 imagehash.phash 使用同一个 DCT，版本见 requirements.txt
 import matplotlib.pyplot as plt
 from datasketch import MinHashLSH, MinHash
 from PIL import Image
 
 import utils
+import duplicates
+import resolve
+from instrument import stats, Progress
+from io_pool import read_bytes
+from hamming_index import HammingIndex, connected_groups, hex_to_uint64
+from hash_index import HashIndex, HashRecord, HASH_VERSION
+from thumbnail_cache import ThumbnailCache
 
 
 # 支持中文
 plt.rcParams['font.sans-serif'] = ['SimHei']
 
 
-# 加载缓存（如果存在）
-def load_cache(cache_file='cache.json'):
-    if os.path.exists(cache_file):
-        with open(cache_file, "r") as f:
-            cache = json.load(f)
-            print(f'Cache loaded from {cache_file}')
-            return cache
-    return {}
+# 快速解码时的目标边长，phash 最终只用 32x32，留出余量保证和全尺寸解码的结果基本一致
+FAST_DECODE_SIZE = 256
+# 快速解码得到的 pHash 在索引中用单独的算法名，和全尺寸解码的结果区分开
+PHASH = 'phash'
+PHASH_FAST = 'phash_fast'
 
+# dHash、aHash、colorhash 共用的缩小后的图片边长
+FINGERPRINT_SIZE = 64
+# pHash 找到的候选再依次用 dHash、colorhash 验证的阈值（汉明距离）
+DHASH_THRESHOLD = 10
+COLORHASH_THRESHOLD = 6
 
-# 保存缓存
-def save_cache(cache_file='cache.json', cache=None):
-    with open(cache_file, "w") as f:
-        json.dump(cache, f, indent=4)
-    print(f'Cache saved to {cache_file}')
+
+def open_image(path: str, fast: bool = False, fmt: str = None) -> Image.Image:
+    """
+    打开图片用于计算 pHash
+    :param fast: 是否使用低分辨率解码：
+        - JPEG 使用 Pillow 的 draft 模式直接按 1/2~1/8 缩放解码
+        - RAW 使用内嵌的 JPEG 预览图
+        - 其他格式（HEIC 等）无法降分辨率解码，解码后先用 reduce 快速缩小
+    :param fmt: utils.sniff_format 判断的格式，为 None 时按后缀判断
+    """
+    is_raw = fmt in utils.raw_formats if fmt is not None else Path(path).suffix in utils.raw_img_suffix
+    if is_raw:
+        with rawpy.imread(path) as raw:
+            if fast:
+                try:
+                    thumb = raw.extract_thumb()
+                except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+                    thumb = None
+                if thumb is not None and thumb.format == rawpy.ThumbFormat.JPEG:
+                    img = Image.open(io.BytesIO(thumb.data))
+                elif thumb is not None:
+                    img = Image.fromarray(thumb.data)
+                else:
+                    img = Image.fromarray(raw.postprocess(half_size=True))
+            else:
+                img = Image.fromarray(raw.postprocess())
+    else:
+        img = Image.open(read_bytes(path))  # 一次顺序读取整个文件
+
+    if not fast:
+        return img
+
+    if img.format == 'JPEG':
+        # 按彩色解码，colorhash 需要颜色；灰度解码的 JPEG 和同一张 PNG 的 colorhash 不同
+        img.draft('RGB', (FAST_DECODE_SIZE, FAST_DECODE_SIZE))
+
+    # 避免 phash 里对全尺寸图片做 LANCZOS 缩放
+    factor = min(img.size) // FAST_DECODE_SIZE
+    if factor > 1:
+        img = img.reduce(factor)
+    return img
 
 
 # 计算 pHash
-def compute_phash(image_entry):
+def compute_phash(image_entry, fast: bool = False):
+    return compute_phash_from_path(image_entry.path, fast, utils.detect_format(image_entry))
+
+
+# DirEntry 不能 pickle，子进程里只传路径
+def compute_phash_from_path(path: str, fast: bool = False, fmt: str = None):
     try:
-        img = Image.open(image_entry.path).convert('L')  # 转灰度
+        img = open_image(path, fast, fmt).convert('L')  # 转灰度
     except OSError:
-        print('cannot open', image_entry.path)
+        print('cannot open', path)
         raise
     hash = str(imagehash.phash(img))
     img.close()
     return hash
 
 
+# DCT 第 k 行（列）在图片上下（左右）翻转后的符号
+_dct_parity = (-1.0) ** np.arange(8)
+
+
+def canonical_dct(lowfreq: np.ndarray) -> np.ndarray:
+    """
+    把 8x8 低频 DCT 系数变换到 8 种旋转、翻转中固定的一种，同一张图片的 8 种旋转、翻转得到相同的结果
+    图片左右翻转 = 第 v 列乘 (-1)^v，上下翻转 = 第 u 行乘 (-1)^u，沿对角线翻转 = 转置，8 种组合即全部的旋转和翻转
+    规定 |C[0,1]| >= |C[1,0]|、C[0,1] >= 0、C[1,0] >= 0（最强的水平和垂直梯度方向固定）
+    """
+    if abs(lowfreq[1, 0]) > abs(lowfreq[0, 1]):
+        lowfreq = lowfreq.T
+    if lowfreq[0, 1] < 0:
+        lowfreq = lowfreq * _dct_parity[None, :]
+    if lowfreq[1, 0] < 0:
+        lowfreq = lowfreq * _dct_parity[:, None]
+    return lowfreq
+
+
+def _dct_to_hash(lowfreq: np.ndarray) -> str:
+    return str(imagehash.ImageHash(lowfreq > np.median(lowfreq)))
+
+
+def phash_with_invariant(gray: Image.Image) -> tuple[str, str]:
+    """
+    和 imagehash.phash 相同的计算，同时从同一个 32x32 DCT 得到旋转、翻转不变的 pHash
+    :return: (pHash, 旋转不变 pHash)
+    """
+    pixels = np.asarray(gray.convert('L').resize((32, 32), imagehash.ANTIALIAS))
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)
+    lowfreq = dct[:8, :8]
+    return _dct_to_hash(lowfreq), _dct_to_hash(canonical_dct(lowfreq))
+
+
+def compute_fingerprints_timed(path: str, fast: bool = False, fmt: str = None) -> tuple[tuple[str, str, str, str, str], float, float]:
+    """
+    只解码一次，计算 pHash、dHash、aHash、colorhash 和旋转不变 pHash。pHash 和 compute_phash_from_path 的结果相同，
+    dHash、aHash、colorhash 从同一张缩小到 FINGERPRINT_SIZE 的图片计算。另外返回解码和计算的耗时，子进程中的耗时由主进程汇总到 stats
+    :return: ((pHash, dHash, aHash, colorhash, 旋转不变 pHash), 解码耗时, 计算耗时)
+    """
+    start = time.perf_counter()
+    try:
+        img = open_image(path, fast, fmt)
+        img.load()
+    except OSError:
+        print('cannot open', path)
+        raise
+    decoded = time.perf_counter()
+
+    gray = img.convert('L')  # 转灰度
+    phash, phash_invariant = phash_with_invariant(gray)
+    gray.close()
+
+    small = img if img.mode == 'RGB' else img.convert('RGB')
+    small.thumbnail((FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+    fingerprints = (phash, str(imagehash.dhash(small)), str(imagehash.average_hash(small)),
+                    str(imagehash.colorhash(small, binbits=3)), phash_invariant)
+    small.close()
+    img.close()
+    return fingerprints, decoded - start, time.perf_counter() - decoded
+
+
+class CascadeVerifier:
+    """
+    pHash 汉明距离在阈值内的候选对，再依次要求 dHash、colorhash 的距离也在阈值内，任意一级不满足即不相似
+    只用一个 pHash 阈值时，阈值小会漏掉编辑过的副本，阈值大会把连拍误判为相似；多级验证时可以放宽 pHash 阈值
+    没有其他指纹的图片（旧的记录）只用 pHash 判断
+    """
+    def __init__(self, relative_paths: list[str], fingerprints: dict[str, tuple[str, str, str, str]],
+                 dhash_threshold: int | None = DHASH_THRESHOLD, colorhash_threshold: int = COLORHASH_THRESHOLD):
+        """
+        :param relative_paths: 下标即图片的 id，和查询时的 hashes 对应
+        :param fingerprints: HashIndex.all_fingerprints 的结果，path: (dHash, aHash, colorhash, 旋转不变 pHash)
+        :param dhash_threshold: 为 None 时不验证 dHash（dHash 随旋转、翻转变化，查询旋转过的副本时不能使用）
+        """
+        self.valid = np.array([path in fingerprints for path in relative_paths], dtype=bool)
+        self.dhashes = hex_to_uint64([fingerprints[path][0] if path in fingerprints else '0' for path in relative_paths])
+        self.colorhashes = hex_to_uint64([fingerprints[path][2] if path in fingerprints else '0' for path in relative_paths])
+        self.dhash_threshold = dhash_threshold
+        self.colorhash_threshold = colorhash_threshold
+
+    def verify(self, i, j) -> np.ndarray:
+        """
+        :param i: id 或 id 数组
+        :param j: id 或 id 数组，和 i 按 numpy 规则广播
+        :return: 每一对是否通过验证
+        """
+        i, j = np.asarray(i), np.asarray(j)
+        passed = np.bitwise_count(self.colorhashes[i] ^ self.colorhashes[j]) <= self.colorhash_threshold
+        if self.dhash_threshold is not None:
+            passed &= np.bitwise_count(self.dhashes[i] ^ self.dhashes[j]) <= self.dhash_threshold
+        return passed | ~(self.valid[i] & self.valid[j])
+
+
 # pHash 转 MinHash（用于 LSH 近似搜索）
 def hash_to_minhash(phash):
     # 将 pHash 转为 bit 串，例如 64 位二进制
@@ -61,29 +212,153 @@ def hamming_distance(hash1, hash2):
     return bin(int(hash1, 16) ^ int(hash2, 16)).count('1')
 
 
-# LSH 初始化（阈值 0.8，允许一定误差）
-lsh = MinHashLSH(threshold=0.8, num_perm=128)
+def query_hashes(relative_paths: list[str], phash_db: dict[str, str], fingerprints: dict[str, tuple[str, str, str, str]] = None,
+                 invariant: bool = False) -> tuple[np.ndarray, CascadeVerifier | None]:
+    """
+    查询使用的 hash 和验证器
+    :param invariant: True 时使用旋转、翻转不变的 pHash，可以找到旋转或镜像过的副本；没有旋转不变 pHash 的旧记录仍使用 pHash
+    """
+    if invariant and fingerprints is not None:
+        hashes = hex_to_uint64([fingerprints[path][3] if path in fingerprints and fingerprints[path][3] else phash_db[path]
+                                for path in relative_paths])
+        return hashes, CascadeVerifier(relative_paths, fingerprints, dhash_threshold=None)
+    hashes = hex_to_uint64([phash_db[relative_path] for relative_path in relative_paths])
+    return hashes, CascadeVerifier(relative_paths, fingerprints) if fingerprints is not None else None
 
 
-def query_similar_images(folders: utils.Folder, phash_db: dict[str, str]):
-    # 记录已处理的图片
+def query_similar_images(folders: utils.Folder, phash_db: dict[str, str], threshold: int = 2, mode: str = 'exact', workers: int = 1,
+                         image_entries: list[nt.DirEntry] = None, fingerprints: dict[str, tuple[str, str, str, str]] = None,
+                         invariant: bool = False):
+    """
+    :param threshold: pHash 汉明距离阈值，一般用 2，传入 fingerprints 时可以放宽到 4
+    :param mode: 'exact' 使用 HammingIndex 精确查找，
+                 'blocked' 分块暴力比较所有图片，相似的图片连成一组（连通分量），
+                 'lsh' 使用 MinHash LSH 近似查找（用于对比）
+    :param workers: 'blocked' 模式下的线程数
+    :param image_entries: utils.scan_media 的结果，为 None 时重新扫描
+    :param fingerprints: HashIndex.all_fingerprints 的结果，传入时 pHash 的候选再用 CascadeVerifier 验证（'lsh' 模式不使用）
+    :param invariant: 使用旋转、翻转不变的 pHash，需要传入 fingerprints，见 query_hashes
+    """
     print('Querying similar images...')
+    if image_entries is None:
+        image_entries = utils.scan_media(folders, utils.MediaType.all_image(), all_files=True)
+    # generate_cache 会跳过内容不是图片的文件
+    image_entries = [entry for entry in image_entries if folders.get_relative_path(entry.path) in phash_db]
+
+    if mode == 'lsh':
+        return query_similar_images_lsh(folders, phash_db, image_entries, threshold)
+    elif mode not in ('exact', 'blocked'):
+        raise ValueError(f'unknown mode {mode}')
+
+    relative_paths = [folders.get_relative_path(entry.path) for entry in image_entries]
+    hashes, verifier = query_hashes(relative_paths, phash_db, fingerprints, invariant)
+
+    if mode == 'blocked':
+        with stats.timer('query', len(image_entries)):
+            groups = connected_groups(hashes, radius=threshold, workers=workers,
+                                      pair_filter=verifier.verify if verifier is not None else None)
+        return [[(image_entries[i], dist) for i, dist in group] for group in groups]
+
+    with stats.timer('index_build', len(hashes)):
+        index = HammingIndex(hashes, radius=threshold)
+
+    checked = np.zeros(len(image_entries), dtype=bool)
+    similar_groups: list[list[tuple[nt.DirEntry, int]]] = []
+
+    # 查找相似图片
+    with stats.timer('query', len(image_entries)):
+        for i, entry in enumerate(image_entries):
+            if checked[i]:
+                continue
+
+            similar_images = [(entry, 0)]  # 自己也算一个
+            checked[i] = True
+
+            for j, dist in index.query_id(i):
+                if not checked[j] and (verifier is None or verifier.verify(i, j)):
+                    similar_images.append((image_entries[j], dist))
+                    checked[j] = True
+
+            # 记录相似组
+            if len(similar_images) > 1:
+                similar_groups.append(similar_images)
+
+    return similar_groups
+
+
+def query_new_similar_images(folders: utils.Folder, phash_db: dict[str, str], hash_index: HashIndex, threshold: int = 2,
+                             image_entries: list[nt.DirEntry] = None, fingerprints: dict[str, tuple[str, str, str, str]] = None,
+                             invariant: bool = False):
+    """
+    增量查询：只用新加入或 pHash 变化的图片查询全部图片，返回包含新图片的相似组
+    已经查询过的图片记录在 hash_index 的 indexed 表中，remove_similar_images 结束后调用 hash_index.mark_indexed 更新
+    :param image_entries: utils.scan_media 的结果，为 None 时重新扫描
+    :param fingerprints: 同 query_similar_images
+    :param invariant: 同 query_similar_images
+    :return: (相似组, 本次新查询的 path: pHash)
+    """
+    print('Querying similar images for new images...')
+    if image_entries is None:
+        image_entries = utils.scan_media(folders, utils.MediaType.all_image(), all_files=True)
+    # generate_cache 会跳过内容不是图片的文件
+    image_entries = [entry for entry in image_entries if folders.get_relative_path(entry.path) in phash_db]
+    relative_paths = [folders.get_relative_path(entry.path) for entry in image_entries]
+
+    indexed = hash_index.get_indexed()
+    new_ids = [i for i, relative_path in enumerate(relative_paths) if indexed.get(relative_path) != phash_db[relative_path]]
+    print(f'{len(new_ids)} new images, {len(image_entries) - len(new_ids)} already indexed')
+
+    # 索引由 hash 直接构建，100 万张以内不到一秒，不需要单独保存
+    hashes, verifier = query_hashes(relative_paths, phash_db, fingerprints, invariant)
+    with stats.timer('index_build', len(hashes)):
+        index = HammingIndex(hashes, radius=threshold)
+
+    checked = np.zeros(len(image_entries), dtype=bool)
+    similar_groups: list[list[tuple[nt.DirEntry, int]]] = []
+
+    with stats.timer('query', len(new_ids)):
+        for i in new_ids:
+            if checked[i]:
+                continue
+
+            similar_images = [(image_entries[i], 0)]  # 自己也算一个
+            checked[i] = True
+
+            for j, dist in index.query_id(i):
+                if not checked[j] and (verifier is None or verifier.verify(i, j)):
+                    similar_images.append((image_entries[j], dist))
+                    checked[j] = True
+
+            if len(similar_images) > 1:
+                similar_groups.append(similar_images)
+
+    new_hashes = {relative_paths[i]: phash_db[relative_paths[i]] for i in new_ids}
+    return similar_groups, new_hashes
+
+
+def filter_kept_groups(folder: str, similar_groups: list[list[tuple[nt.DirEntry, int]]], hash_index: HashIndex):
+    """
+    去掉用户已经选择保留（输入 n）的相似组，组内所有图片都在同一个已保留的组中时不再展示
+    """
+    kept_groups = hash_index.kept_groups()
+    result = []
+    for group in similar_groups:
+        paths = {os.path.relpath(image_entry.path, folder) for image_entry, _ in group}
+        if not any(paths <= kept for kept in kept_groups):
+            result.append(group)
+    print(f'Skipped {len(similar_groups) - len(result)} groups kept before')
+    return result
+
+
+def query_similar_images_lsh(folders: utils.Folder, phash_db: dict[str, str], image_entries: list[nt.DirEntry], threshold: int = 2):
     checked_images = set()
-    similar_groups: list[tuple[nt.DirEntry, int]] = []
-    image_entries: list[nt.DirEntry] = []
-
-    for folder in folders:
-        print(f'path: {folder.path}')
-        batch_num = 0
-        for batch in utils.load_media_batch(folder.path, 64, media_type=utils.MediaType.all_image(), all_files=True):
-            for entry in batch:
-                image_entries.append(entry)
-                relative_path = folders.get_relative_path(entry.path)
-                phash = phash_db[relative_path]
-                mhash = hash_to_minhash(phash)
-                lsh.insert(entry, mhash)
-
-            batch_num += 1
+    similar_groups: list[list[tuple[nt.DirEntry, int]]] = []
+
+    # LSH 初始化（阈值 0.8，允许一定误差）
+    lsh = MinHashLSH(threshold=0.8, num_perm=128)
+    for entry in image_entries:
+        relative_path = folders.get_relative_path(entry.path)
+        lsh.insert(entry, hash_to_minhash(phash_db[relative_path]))
 
     # 查找相似图片
     for entry in image_entries:
@@ -102,7 +377,7 @@ def query_similar_images(folders: utils.Folder, phash_db: dict[str, str]):
         for candidate in candidates:
             if candidate != entry and candidate not in checked_images:
                 dist = hamming_distance(phash_db[relative_path], phash_db[folders.get_relative_path(candidate.path)])
-                if dist <= 2:  # 设定 pHash 相似度阈值， 一般用 2
+                if dist <= threshold:  # 设定 pHash 相似度阈值
                     similar_images.append((candidate, dist))
                     checked_images.add(candidate)
 
@@ -113,9 +388,19 @@ def query_similar_images(folders: utils.Folder, phash_db: dict[str, str]):
     return similar_groups
 
 
-def remove_similar_images(folder, similar_images, fast_del=False):
-    for image_entry_lst in similar_images:
+def remove_similar_images(folder, similar_images, fast_del=False, hash_index: HashIndex = None,
+                          thumbnails: ThumbnailCache = None, prefetch: int = 4):
+    """
+    :param hash_index: 传入时，用户选择不删除（输入 n）的相似组会记录到索引中
+    :param thumbnails: 传入时展示缓存的缩略图而不是原图，并在等待输入时后台生成之后几组的缩略图
+    :param prefetch: 提前生成缩略图的组数
+    """
+    for group_index, image_entry_lst in enumerate(similar_images):
         n = len(image_entry_lst)
+        if thumbnails is not None:
+            # 当前组和之后 prefetch 组，已经提交的不会重复提交
+            for entry_lst in similar_images[group_index:group_index + prefetch + 1]:
+                thumbnails.prefetch([image_entry.path for image_entry, _ in entry_lst])
 
         if fast_del:
             fast_del_list = []
@@ -125,16 +410,16 @@ def remove_similar_images(folder, similar_images, fast_del=False):
                     fast_del_list.append(index)
                     continue
 
-            fast_del_list.sort(key=lambda i: os.path.getsize(image_entry_lst[i][0].path), reverse=True)
+            fast_del_list.sort(key=lambda i: image_entry_lst[i][0].stat().st_size, reverse=True)
             max_file_index = fast_del_list.pop(0)  # 留下一张体积最大，且日期最旧的图片。虽然有元数据影响文件大小，但对于大图片来说可以忽略
 
             # 重复的图片都可以删除
             if len(fast_del_list) == n - 1:
-                print(f'file sizes are {[utils.file_size_to_str(os.path.getsize(image_entry.path)) for image_entry, diff in image_entry_lst]}')
-                print(f'keep file {max_file_index}, size {utils.file_size_to_str(os.path.getsize(image_entry_lst[max_file_index][0].path))}')
+                print(f'file sizes are {[utils.file_size_to_str(image_entry.stat().st_size) for image_entry, diff in image_entry_lst]}')
+                print(f'keep file {max_file_index}, size {utils.file_size_to_str(image_entry_lst[max_file_index][0].stat().st_size)}')
                 print()
-                for rm in fast_del_list:
-                    utils.del_image(image_entry_lst[int(rm)][0])
+                utils.del_images([image_entry_lst[int(rm)][0].path for rm in fast_del_list],
+                                 keep=[image_entry_lst[max_file_index][0].path])
                 continue
 
         # 展示全部图片，一行两张
@@ -142,8 +427,11 @@ def remove_similar_images(folder, similar_images, fast_del=False):
         for index, (image_entry, diff) in enumerate(image_entry_lst):
             plt.subplot((n+1) // 2, 2, index+1)
             try:
-                plt.imshow(plt.imread(image_entry.path))
-            except SyntaxError as e:
+                if thumbnails is not None:
+                    plt.imshow(thumbnails.load(image_entry.path))
+                else:
+                    plt.imshow(plt.imread(image_entry.path))
+            except (SyntaxError, OSError) as e:
                 print(f'Error: {e}')
                 print(f'Error file: {image_entry.path}')
                 # exit(1)
@@ -152,22 +440,23 @@ def remove_similar_images(folder, similar_images, fast_del=False):
             # 过长换行
             if len(path_display) > 50:
                 path_display = path_display[:50] + '\n' + path_display[50:]
-            plt.title(f'{path_display} \n diff:{diff} index:{index} \n size:{utils.file_size_to_str(os.path.getsize(image_entry.path))}', fontsize=20)
+            plt.title(f'{path_display} \n diff:{diff} index:{index} \n size:{utils.file_size_to_str(image_entry.stat().st_size)}', fontsize=20)
         plt.show(block=False)
 
         rm_lst = input('remove list: ')
         if rm_lst == 'n':  # 'n' 表示不删除
+            if hash_index is not None:
+                hash_index.add_kept_group([os.path.relpath(image_entry.path, folder) for image_entry, _ in image_entry_lst])
             plt.close()
             continue
 
-        rm_lst = rm_lst.split()
-        for rm in rm_lst:
-            utils.del_image_dry_run(image_entry_lst[int(rm)][0])
+        rm_paths = [image_entry_lst[int(rm)][0].path for rm in rm_lst.split()]
+        keep_paths = [image_entry.path for image_entry, _ in image_entry_lst if image_entry.path not in rm_paths]
+        utils.del_images(rm_paths, dry_run=True, keep=keep_paths)
         confirm = input('confirm? (Y/n): ')
 
         if confirm != 'n' and confirm != 'N':
-            for rm in rm_lst:
-                utils.del_image(image_entry_lst[int(rm)][0])
+            utils.del_images(rm_paths, keep=keep_paths)
 
         plt.close()
 
@@ -180,48 +469,97 @@ def export_similar_images(folder, similar_images):
             f.write('\n')
 
 
-def generate_cache(folders: utils.Folder, save_interval=10):
+def generate_cache(folders: utils.Folder, save_interval=10, workers: int = 1, fast: bool = False,
+                   image_entries: list[nt.DirEntry] = None, need_fingerprints: bool = True):
     """
+    每张图片解码一次，计算 pHash 和 dHash、aHash、colorhash，一起存入索引
     :param folders: utils.Folder 对象，包含所有需要处理的文件夹
-    :param save_interval: 几批次保存一次缓存
+    :param save_interval: 几批次提交一次索引
+    :param workers: 计算 pHash 的进程数，1 表示在主进程中计算
+    :param fast: 是否使用低分辨率解码计算 pHash，非 fast 模式下索引中 fast 的结果会被重新计算
+    :param image_entries: utils.scan_media 的结果，为 None 时重新扫描
+    :param need_fingerprints: 为 True 时只有 pHash 的旧记录也重新计算
     """
-    cache_file = f'{folders.path}\\cache.json'
-    cache = load_cache(cache_file)  # 加载缓存
+    if image_entries is None:
+        image_entries = utils.scan_media(folders, utils.MediaType.all_image(), all_files=True)
+
+    index = HashIndex(os.path.join(folders.path, 'cache.db'))
+    index.import_json_cache(os.path.join(folders.path, 'cache.json'), folders.path)  # 导入旧的 cache.json
+
+    algorithm = PHASH_FAST if fast else PHASH
+    accepted_algorithms = (PHASH, PHASH_FAST) if fast else (PHASH,)
 
     phash_db: dict[str, str] = {}  # 存储文件路径和对应的 pHash
 
     batch_processed = 0  # 处理的批次数
 
-    for folder in folders:
-        print(f'path: {folder.path}')
-        batch_num = 0
-        for batch in utils.load_media_batch(folder.path, 64, media_type=utils.MediaType.all_image(), all_files=True):
-            print(f'batch {batch_num}, size {len(batch)}')
-
-            all_cached = True
-            for entry in batch:
-                relative_path = folders.get_relative_path(entry.path)
-                print(relative_path)
-                # 如果路径在缓存中，直接使用缓存的 pHash
-                if relative_path in cache:
-                    phash = cache[relative_path]
-                # 如果缓存中没有，计算 pHash 并存入缓存
-                else:
-                    all_cached = False
-                    phash = compute_phash(entry)
-                    cache[relative_path] = phash
+    # pHash 计算是 CPU 密集的，多进程时每个 batch 分发给进程池
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
 
+    progress = Progress('pHash', len(image_entries))
+    try:
+        for batch in utils.batched(image_entries, 64):
+            relative_paths = [folders.get_relative_path(entry.path) for entry in batch]
+            with stats.timer('index_lookup', len(relative_paths)):
+                records = index.get_many(relative_paths)
+
+            uncached: list[tuple[str, nt.DirEntry]] = []
+            for relative_path, entry in zip(relative_paths, batch):
+                stat = entry.stat()
+                record = records.get(relative_path)
+                # 如果索引中的记录没有过期，直接使用
+                if record is not None and record.is_fresh(stat.st_size, stat.st_mtime, accepted_algorithms, need_fingerprints):
+                    phash_db[relative_path] = record.phash
+                # 否则之后计算 pHash 并存入索引
+                else:
+                    uncached.append((relative_path, entry))
+
+            # 按文件头判断格式，后缀是图片但内容不是图片的文件跳过
+            formats = utils.detect_formats([entry for _, entry in uncached])
+            to_hash = []
+            for relative_path, entry in uncached:
+                if utils.format_media_type.get(formats[entry.path]) in (utils.MediaType.IMAGE, utils.MediaType.RAW_IMAGE):
+                    to_hash.append((relative_path, entry))
+                else:
+                    print(f'{relative_path} is {formats[entry.path]}, skipped')
+            uncached = to_hash
+
+            paths = [entry.path for _, entry in uncached]
+            fmts = [formats[entry.path] for _, entry in uncached]
+            if executor is None:
+                results = map(compute_fingerprints_timed, paths, repeat(fast), fmts)
+            else:
+                results = executor.map(compute_fingerprints_timed, paths, repeat(fast), fmts,
+                                       chunksize=max(1, len(paths) // (workers * 2)))
+
+            # 结果按提交顺序返回
+            new_records = []
+            for (relative_path, entry), fmt, (fingerprints, decode_time, hash_time) in zip(uncached, fmts, results):
+                stats.add('decode', 1, decode_time)
+                stats.add('hash', 1, hash_time)
+                stat = entry.stat()
+                phash, dhash, ahash, colorhash, phash_invariant = fingerprints
+                new_records.append(HashRecord(relative_path, stat.st_size, stat.st_mtime, phash, algorithm, HASH_VERSION, fmt,
+                                              dhash, ahash, colorhash, phash_invariant))
                 phash_db[relative_path] = phash
 
-            batch_num += 1
-            if not all_cached:
-                batch_processed += 1
-
-            if batch_processed != 0 and batch_processed % save_interval == 0:
-                print(f'Saving cache after {batch_processed} batches...')
-                save_cache(cache_file, cache)
-
-    save_cache(cache_file, cache)  # 保存缓存
+            with stats.timer('index_insert', len(new_records)):
+                index.put_many(new_records)
+                if uncached:
+                    batch_processed += 1
+                    if batch_processed % save_interval == 0:
+                        index.commit()
+            progress.update(len(batch))
+    finally:
+        progress.close()
+        if executor is not None:
+            executor.shutdown()
+        index.commit()
+
+    # 删除已经被删除的图片的记录
+    pruned = index.prune(set(phash_db.keys()))
+    print(f'Pruned {pruned} deleted images from index')
+    index.close()
 
     return phash_db
 
@@ -231,11 +569,54 @@ def generate_cache(folders: utils.Folder, save_interval=10):
 if __name__ == '__main__':
     folders = utils.load_config('folders.yaml')
 
-    phash_db = generate_cache(folders, save_interval=10)
-
-    similar_images = query_similar_images(folders, phash_db)
-    # TODO 删除已经被删除的图片的 cache
-
-    print(f'Found {len(similar_images)} similar groups')
-    remove_similar_images(folders.path, similar_images, fast_del=False)
+    incremental = True  # 只查询新加入的图片
+    orientation_invariant = False  # 同时查找旋转、镜像过的副本（不使用 dHash 验证）
+    batch_resolve = False  # 不逐组询问，按 resolve.default_policies 自动选择，结果合并到 similar_decisions.json，用 resolve.py 执行
+
+    # 只扫描一次，计算 pHash 和查询共用
+    image_entries = utils.scan_media(folders, utils.MediaType.all_image(), all_files=True)
+
+    # 先找出内容完全相同的文件（不需要解码），每组只有保留的文件进入 pHash 计算和相似查询
+    exact_groups = duplicates.find_exact_duplicates(image_entries)
+    exact_duplicates = set()
+    for group in exact_groups:
+        keep = duplicates.choose_keep(group)
+        exact_duplicates.update(entry.path for entry in group if entry is not keep)
+    image_entries = [entry for entry in image_entries if entry.path not in exact_duplicates]
+    print(f'Found {len(exact_duplicates)} exact duplicates in {len(exact_groups)} groups')
+    if not batch_resolve:
+        duplicates.remove_exact_duplicates(exact_groups)
+
+    phash_db = generate_cache(folders, save_interval=10, workers=os.cpu_count(), image_entries=image_entries)
+
+    with HashIndex(os.path.join(folders.path, 'cache.db')) as hash_index, \
+            ThumbnailCache(os.path.join(folders.path, '.thumbnails')) as thumbnails:
+        # pHash 放宽到 4，候选再用 dHash、colorhash 验证
+        fingerprints = hash_index.all_fingerprints()
+        if incremental:
+            similar_images, new_hashes = query_new_similar_images(folders, phash_db, hash_index, threshold=4,
+                                                                  image_entries=image_entries, fingerprints=fingerprints,
+                                                                  invariant=orientation_invariant)
+        else:
+            similar_images = query_similar_images(folders, phash_db, threshold=4, image_entries=image_entries,
+                                                  fingerprints=fingerprints, invariant=orientation_invariant)
+            new_hashes = phash_db
+        similar_images = filter_kept_groups(folders.path, similar_images, hash_index)
+
+        print(f'Found {len(similar_images)} similar groups')
+        if batch_resolve:
+            decisions = resolve.resolve_groups(similar_images, workers=os.cpu_count())
+            # 完全相同的文件不需要比较，直接保留 choose_keep 选择的文件
+            for group in exact_groups:
+                keep = duplicates.choose_keep(group)
+                decisions.append(resolve.Decision(keep.path, [entry.path for entry in group if entry is not keep]))
+            # 合并到已有的记录，之前执行过的组撤销时还需要其中的 trashed
+            resolve.add_decisions(decisions, os.path.join(folders.path, 'similar_decisions.json'))
+        else:
+            remove_similar_images(folders.path, similar_images, fast_del=False, hash_index=hash_index, thumbnails=thumbnails)
+        # 全部处理完后才记录，中途退出时下次会重新展示
+        hash_index.mark_indexed(new_hashes)
+
+    stats.print_summary()
+    stats.save(os.path.join(folders.path, 'stats_similarity.json'))
     # export_similar_images(folder, similar_images)
\ No newline at end of file
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# 代码中用 nt.DirEntry 作类型标注，非 Windows 平台上用 os 代替
+sys.modules.setdefault('nt', os)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import rename
+
+
+def _contents(folder) -> dict[str, str]:
+    contents = {}
+    for root, _, files in os.walk(folder):
+        for name in files:
+            with open(os.path.join(root, name)) as f:
+                contents[os.path.relpath(os.path.join(root, name), folder)] = f.read()
+    return contents
+
+
+def test_replaying_chained_plan_does_not_overwrite(tmp_path):
+    (tmp_path / 'IMG_2.jpg').write_text('original')
+    (tmp_path / 'x.jpg').write_text('new')
+    # IMG_2.jpg 先移走，x.jpg 再占用它原来的名字
+    plan = [rename.Move(str(tmp_path / 'IMG_2.jpg'), str(tmp_path / '2024' / 'y.jpg')),
+            rename.Move(str(tmp_path / 'x.jpg'), str(tmp_path / 'IMG_2.jpg'))]
+
+    rename.apply_plan(plan, str(tmp_path))
+    expected = {'IMG_2.jpg': 'new', os.path.join('2024', 'y.jpg'): 'original'}
+    assert _contents(tmp_path) == expected
+
+    rename.apply_plan(plan, str(tmp_path))  # 中断后重放
+    assert _contents(tmp_path) == expected
+
+
+def test_failed_move_does_not_lose_other_moves(tmp_path, monkeypatch):
+    for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+        (tmp_path / 'old' / name).parent.mkdir(exist_ok=True)
+        (tmp_path / 'old' / name).write_text(name)
+    plan = [rename.Move(str(tmp_path / 'old' / name), str(tmp_path / '2024' / name)) for name in ('a.jpg', 'b.jpg', 'c.jpg')]
+    move_file = rename.move_file
+
+    def failing_move(src, dst):
+        if src.endswith('b.jpg'):
+            raise OSError('b.jpg is busy')
+        return move_file(src, dst)
+
+    monkeypatch.setattr(rename, 'move_file', failing_move)
+    moved = []
+    monkeypatch.setattr(rename.HashIndex, 'move_live_photos', lambda self, moves: moved.extend(moves))
+
+    with pytest.raises(OSError, match='b.jpg'):
+        rename.apply_plan(plan, str(tmp_path), hash_index=rename.HashIndex.__new__(rename.HashIndex))
+    # 失败的移动之外，其他移动都已经执行并记录
+    assert _contents(tmp_path) == {os.path.join('old', 'b.jpg'): 'b.jpg',
+                                   os.path.join('2024', 'a.jpg'): 'a.jpg',
+                                   os.path.join('2024', 'c.jpg'): 'c.jpg'}
+    assert sorted(moved) == [(plan[0].src, plan[0].dst), (plan[2].src, plan[2].dst)]
+
+
+def test_live_photo_uuid_with_three_files_is_rejected(tmp_path, monkeypatch):
+    for name in ('a.jpg', 'a.mov', 'b.mov'):
+        (tmp_path / name).write_bytes(b'')
+    monkeypatch.setattr(rename.utils, 'read_metadata_batch', lambda entries: {})
+    monkeypatch.setattr(rename.utils, 'get_content_uuid', lambda entry: 'A')
+    entries = {entry.name: entry for entry in os.scandir(tmp_path)}
+
+    with rename.HashIndex(str(tmp_path / 'cache.db')) as hash_index:
+        pairer = rename.LivePhotoPairer(SimpleNamespace(path=str(tmp_path)), hash_index)
+        file_entry_map, _ = pairer.add_batch([entries['a.jpg'], entries['a.mov']])
+        assert sorted(entry.name for entry in file_entry_map['A']) == ['a.jpg', 'a.mov']
+        # 配对完成之后的 batch 中又出现同一个 UUID
+        with pytest.raises(ValueError, match='UUID has multiple files'):
+            pairer.add_batch([entries['b.mov']])
+
+
+@pytest.mark.parametrize('name', ['a.heic', 'a.Heic', 'a.HEIC', 'a.heif'])
+def test_heic_suffix_is_converted_in_any_case(tmp_path, name):
+    (tmp_path / name).write_bytes(b'\0\0\0\x18ftypheic\0\0\0\0mif1heic')
+    entry = next(os.scandir(tmp_path))
+    assert rename.target_suffix(entry) == ('.jpg', True)
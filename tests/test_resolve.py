@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import resolve
+import utils
+
+
+def test_failed_trash_move_keeps_completed_moves(tmp_path, monkeypatch):
+    for name in ('keep.jpg', 'a.jpg', 'a.MOV', 'b.jpg', 'c.jpg'):
+        (tmp_path / name).write_text(name)
+    decisions = [resolve.Decision(str(tmp_path / 'keep.jpg'), [str(tmp_path / name) for name in ('a.jpg', 'b.jpg', 'c.jpg')])]
+    move_to_trash = utils.move_to_trash
+
+    def failing_move(path, root, trash_folder):
+        if path.endswith('b.jpg'):
+            raise OSError('b.jpg is busy')
+        return move_to_trash(path, root, trash_folder)
+
+    monkeypatch.setattr(utils, 'move_to_trash', failing_move)
+    with pytest.raises(OSError, match='b.jpg'):
+        resolve.apply_decisions(decisions, str(tmp_path))
+    # 失败之前和之后完成的移动都已经记录，可以撤销
+    assert sorted(os.path.basename(src) for src, _ in decisions[0].trashed) == ['a.MOV', 'a.jpg', 'c.jpg']
+
+    resolve.rollback_decisions(decisions, str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ['a.MOV', 'a.jpg', 'b.jpg', 'c.jpg', 'keep.jpg']
+    assert decisions[0].trashed == []
+
+
+def test_trashing_same_path_twice_keeps_both(tmp_path):
+    trash = str(tmp_path / resolve.trash_folder)
+    (tmp_path / 'a.jpg').write_text('first')
+    first = utils.move_to_trash(str(tmp_path / 'a.jpg'), str(tmp_path), trash)
+    (tmp_path / 'a.jpg').write_text('second')
+    second = utils.move_to_trash(str(tmp_path / 'a.jpg'), str(tmp_path), trash)
+
+    assert first != second
+    assert open(first).read() == 'first' and open(second).read() == 'second'
+
+
+def test_add_decisions_keeps_trashed_log(tmp_path):
+    decision_file = str(tmp_path / 'similar_decisions.json')
+    for name in ('keep.jpg', 'a.jpg', 'b.jpg', 'c.jpg'):
+        (tmp_path / name).write_text(name)
+    applied = resolve.Decision(str(tmp_path / 'keep.jpg'), [str(tmp_path / 'a.jpg')])
+    pending = resolve.Decision(str(tmp_path / 'keep.jpg'), [str(tmp_path / 'b.jpg')])
+    resolve.save_decisions([applied, pending], decision_file)
+    decisions = resolve.load_decisions(decision_file)
+    resolve.apply_decisions(decisions[:1], str(tmp_path))
+    resolve.save_decisions(decisions, decision_file)
+
+    # 下一次批量运行：pending 组又被找到，另外有新的一组
+    new = resolve.Decision(str(tmp_path / 'keep.jpg'), [str(tmp_path / 'c.jpg')])
+    resolve.add_decisions([resolve.Decision(pending.keep, pending.remove), new], decision_file)
+
+    decisions = resolve.load_decisions(decision_file)
+    assert [decision.remove for decision in decisions] == [applied.remove, pending.remove, new.remove]
+    resolve.rollback_decisions(decisions, str(tmp_path))
+    assert (tmp_path / 'a.jpg').read_text() == 'a.jpg'
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import similarity
+
+
+def _make_image() -> Image.Image:
+    rng = np.random.default_rng(1)
+    pixels = np.zeros((1200, 1600, 3), np.uint8)
+    pixels[:, :800] = (200, 40, 30)
+    pixels[:, 800:] = (20, 90, 220)
+    pixels[300:900, 400:1200] = (240, 220, 60)
+    pixels = (pixels + rng.integers(0, 30, pixels.shape)).clip(0, 255).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_jpeg_and_png_copies_pass_cascade(tmp_path, fast):
+    img = _make_image()
+    img.save(tmp_path / 'a.jpg', quality=95)
+    img.save(tmp_path / 'a.png')
+
+    fingerprints = {}
+    for name in ('a.jpg', 'a.png'):
+        (phash, *others), _, _ = similarity.compute_fingerprints_timed(str(tmp_path / name), fast)
+        fingerprints[name] = tuple(others)
+
+    verifier = similarity.CascadeVerifier(['a.jpg', 'a.png'], fingerprints)
+    assert verifier.verify(0, 1)
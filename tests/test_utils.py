@@ -0,0 +1,49 @@
+import os
+
+import utils
+
+
+def _touch(folder, *names):
+    for name in names:
+        open(os.path.join(folder, name), 'wb').close()
+
+
+def test_find_related_files_matches_whole_stem(tmp_path):
+    _touch(tmp_path, 'IMG_1.jpg', 'IMG_1.MOV', 'IMG_1.jpg.aae', 'IMG_10.jpg', 'IMG_11.MOV', 'IMG_1_edit.jpg')
+    image_path = str(tmp_path / 'IMG_1.jpg')
+
+    related = utils.find_related_files([image_path])[image_path]
+
+    assert sorted(os.path.basename(path) for path in related) == ['IMG_1.MOV', 'IMG_1.jpg', 'IMG_1.jpg.aae']
+
+
+def test_del_images_keeps_files_sharing_a_prefix(tmp_path):
+    _touch(tmp_path, 'IMG_1.jpg', 'IMG_1.MOV', 'IMG_10.jpg', 'IMG_11.MOV')
+
+    utils.del_images([str(tmp_path / 'IMG_1.jpg')], root=str(tmp_path), trash_folder=str(tmp_path / '.trash'))
+
+    assert sorted(name for name in os.listdir(tmp_path) if name != '.trash') == ['IMG_10.jpg', 'IMG_11.MOV']
+    assert sorted(os.listdir(tmp_path / '.trash')) == ['IMG_1.MOV', 'IMG_1.jpg']
+
+
+def test_raw_to_jpg_batch_skips_clashing_names(tmp_path, monkeypatch):
+    for name in ('a.CR2', 'a.NEF', 'b.CR2'):
+        (tmp_path / name).write_bytes(b'II*\x00' + name.encode())
+    (tmp_path / 'b.jpg').write_bytes(b'camera jpeg')
+
+    def fake_decode(src_path, dst_path, mode):
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            dst.write(src.read())
+
+    class FakeET:
+        def execute(self, *args):
+            pass
+
+    monkeypatch.setattr(utils, 'decode_raw', fake_decode)
+    monkeypatch.setattr(utils, 'get_exiftool', lambda: FakeET())
+    utils.raw_to_jpg_batch(sorted(os.scandir(tmp_path), key=lambda entry: entry.name))
+
+    # a.NEF 和 a.CR2 同名，只转换第一个；b.jpg 是相机拍的 JPG，不覆盖
+    assert sorted(os.listdir(tmp_path)) == ['a.NEF', 'a.jpg', 'b.CR2', 'b.jpg']
+    assert (tmp_path / 'a.jpg').read_bytes() == b'II*\x00a.CR2'
+    assert (tmp_path / 'b.jpg').read_bytes() == b'camera jpeg'
@@ -0,0 +1,83 @@
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from io_pool import read_bytes
+
+
+class ThumbnailCache:
+    """
+    存放在磁盘上的缩略图缓存，按 路径 + 修改时间 区分，文件修改后自动重新生成
+    可以在后台线程中提前生成之后要展示的缩略图，内存中只保留正在展示的图片
+    """
+    def __init__(self, cache_dir: str, size: int = 1024, workers: int = 4):
+        """
+        :param cache_dir: 缩略图存放的文件夹
+        :param size: 缩略图最长边
+        :param workers: 后台生成缩略图的线程数
+        """
+        self.cache_dir = cache_dir
+        self.size = size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures: dict[str, Future] = {}  # path: 生成缩略图的 Future
+
+    def thumbnail_path(self, path: str) -> str:
+        mtime = os.stat(path).st_mtime
+        key = hashlib.sha1(f'{os.path.abspath(path)}|{mtime}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.jpg')
+
+    def generate(self, path: str) -> str:
+        """
+        生成缩略图，已经存在时直接返回
+        :return: 缩略图路径
+        """
+        thumb_path = self.thumbnail_path(path)
+        if os.path.exists(thumb_path):
+            return thumb_path
+
+        with Image.open(read_bytes(path)) as img:
+            if img.format == 'JPEG':
+                img.draft('RGB', (self.size, self.size))  # 按 1/2~1/8 缩放解码
+            img = ImageOps.exif_transpose(img)  # 按 EXIF 方向旋转
+            img.thumbnail((self.size, self.size))
+            img = img.convert('RGB')
+
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        # 先写临时文件再重命名，前台和后台同时生成时不会读到不完整的文件
+        tmp_path = f'{thumb_path}.{os.getpid()}.{id(img)}.tmp'
+        img.save(tmp_path, format='JPEG', quality=85)
+        os.replace(tmp_path, thumb_path)
+        return thumb_path
+
+    def prefetch(self, paths: list[str]):
+        """
+        在后台线程中生成缩略图
+        """
+        for path in paths:
+            if path not in self._futures:
+                self._futures[path] = self.executor.submit(self.generate, path)
+
+    def load(self, path: str) -> np.ndarray:
+        """
+        读取缩略图用于 plt.imshow，后台已经在生成时等待其完成
+        """
+        future = self._futures.pop(path, None)
+        thumb_path = future.result() if future is not None else self.generate(path)
+        with Image.open(thumb_path) as img:
+            return np.asarray(img)
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
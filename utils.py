@@ -1,10 +1,15 @@
+import atexit
 import nt
 import os
 import re
-from collections import deque
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from datetime import datetime, timezone
-from typing import cast, Self
+from datetime import datetime, timedelta, timezone
+from typing import Callable, cast, Iterable, Iterator, Self
 from zoneinfo import ZoneInfo
 
 import rawpy
@@ -14,11 +19,16 @@ from pillow_heif import register_heif_opener
 import exiftool # PyExifTool==0.4.13
 from enum import Enum
 
+from instrument import stats
+from io_pool import io_pool, list_dir, raise_errors, settle
+
 
 register_heif_opener()
 img_suffix = ('.jpg', '.JPG', '.png', '.PNG', '.heic', '.HEIC', '.heif', '.HEIF', '.jpeg', '.JPEG', '.webp', '.WEBP')
 video_suffix = ('.mp4', '.MP4', '.mov', '.MOV', '.avi', '.AVI', '.m4v', '.M4V', '.gif', '.GIF')
 raw_img_suffix = ('.CR3', '.cr3', '.NEF', '.nef', '.ARW', '.arw', '.RAF', '.raf', '.RW2', '.rw2', '.ORF', '.orf', '.SRW', '.srw', '.PEF', '.pef', '.CR2', '.cr2', '.DNG', '.dng')
+# year/month 文件夹（以 4 位或 2 位数字开头），load_media_batch 中 all_files 为 True 时才进入
+year_month_pattern = re.compile(r'\d{2}')
 
 
 # 建议使用 load_media_batch
@@ -93,51 +103,194 @@ class MediaType(Enum):
         return [cls.IMAGE, cls.RAW_IMAGE]
 
 
-def load_media_batch(folder: str, batch_size : int = 64, media_type : list[MediaType] = None, all_files: bool = False):
+# 根据文件头判断的文件格式: 媒体类型，gif 和后缀列表一致归为视频
+format_media_type = {
+    'jpeg': MediaType.IMAGE,
+    'png': MediaType.IMAGE,
+    'heif': MediaType.IMAGE,
+    'webp': MediaType.IMAGE,
+    'gif': MediaType.VIDEO,
+    'mp4': MediaType.VIDEO,
+    'mov': MediaType.VIDEO,
+    'avi': MediaType.VIDEO,
+    'tiff': MediaType.RAW_IMAGE,  # CR2/NEF/ARW/DNG/PEF/SRW 都是 TIFF 容器
+    'cr3': MediaType.RAW_IMAGE,
+    'raf': MediaType.RAW_IMAGE,
+    'rw2': MediaType.RAW_IMAGE,
+    'orf': MediaType.RAW_IMAGE,
+}
+raw_formats = {fmt for fmt, m_type in format_media_type.items() if m_type == MediaType.RAW_IMAGE}
+
+HEAD_SIZE = 32  # 判断格式需要读取的字节数
+
+heif_brands = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'hevm', b'hevs', b'mif1', b'msf1'}
+mov_brands = {b'qt  '}
+
+
+def sniff_format(head: bytes) -> str:
     """
-    批量加载媒体文件，返回一个生成器，每次返回一个 batch 的媒体文件列表。
+    根据文件开头的字节判断文件格式，无法识别时返回 'unknown'
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'RIFF') and head[8:12] == b'AVI ':
+        return 'avi'
+    if head.startswith(b'FUJIFILMCCD-RAW'):
+        return 'raf'
+    if head.startswith(b'IIU\x00'):
+        return 'rw2'
+    if head.startswith((b'IIRO', b'IIRS', b'MMOR')):
+        return 'orf'
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'tiff'
+    # ISO BMFF：4 字节 box 大小 + 'ftyp' + 主品牌
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in heif_brands:
+            return 'heif'
+        if brand == b'crx ':
+            return 'cr3'
+        if brand in mov_brands:
+            return 'mov'
+        return 'mp4'
+    # 老的 QuickTime 文件没有 ftyp
+    if head[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        return 'mov'
+    return 'unknown'
+
+
+# path: (size, mtime, format)，文件大小和修改时间不变时不再重新读取
+_format_cache: dict[str, tuple[int, float, str]] = {}
+
+
+def read_head(path: str, size: int = HEAD_SIZE) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def detect_formats(entries: list[nt.DirEntry]) -> dict[str, str]:
+    """
+    批量判断一个 batch 文件的格式，只读取每个文件开头的 HEAD_SIZE 字节
+    :return: path: format
+    """
+    formats = {}
+    to_read = []
+    for entry in entries:
+        stat = entry.stat()
+        cached = _format_cache.get(entry.path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            formats[entry.path] = cached[2]
+        else:
+            to_read.append(entry)
+
+    # 读取文件头是 I/O 密集的，多个文件时在 io_pool 中并发读取
+    with stats.timer('sniff', len(to_read)):
+        if len(to_read) > 1:
+            heads = io_pool.map(read_head, [entry.path for entry in to_read])
+        else:
+            heads = [read_head(entry.path) for entry in to_read]
+
+    for entry, head in zip(to_read, heads):
+        fmt = sniff_format(head)
+        stat = entry.stat()
+        _format_cache[entry.path] = (stat.st_size, stat.st_mtime, fmt)
+        formats[entry.path] = fmt
+    return formats
+
+
+def detect_format(entry: nt.DirEntry) -> str:
+    return detect_formats([entry])[entry.path]
+
+
+def iter_media(folder: str, media_type: list[MediaType] = None, all_files: bool = False) -> Iterator[nt.DirEntry]:
+    """
+    遍历文件夹，逐个返回媒体文件的 DirEntry。只遍历一次，用栈代替递归，DirEntry 会缓存 stat() 的结果
     :param folder: 文件夹路径
-    :param batch_size: 每个 batch 的大小
     :param media_type: 媒体类型列表，默认为 None，表示加载所有类型的媒体文件
     :param all_files: 是否加载所有文件，False 时不加载已经处理过的文件（存放于 year/month 文件夹下）
     """
-    # all_files: 是否加载所有文件，False 时不加载已经处理过的文件（存放于 year/month 文件夹下）
     if media_type is None:
         media_type = MediaType.all_media()
-    suffix = MediaType.get_suffix_list(media_type)
-    batch = []
+    # 预先转成小写集合，避免每个文件都和整个后缀 tuple 比较
+    suffixes = {suffix.lower() for suffix in MediaType.get_suffix_list(media_type)}
+
+    def expand(entries: list[nt.DirEntry]):
+        # 读到一个文件夹的列表后，它的 year/month 子文件夹同时在 io_pool 中列出，网络文件系统上不需要逐个等待
+        subdirs = {entry.path: io_pool.submit(list_dir, entry.path) for entry in entries
+                   if all_files and entry.is_dir() and year_month_pattern.match(entry.name)}
+        return iter(entries), subdirs
+
+    # 栈中保存每一层的文件列表，遍历顺序和递归时一致（遇到子文件夹时先处理子文件夹）
+    stack = [expand(list_dir(folder))]
+    while stack:
+        entries, subdirs = stack[-1]
+        file_entry = next(entries, None)
+        if file_entry is None:
+            stack.pop()
+            continue
 
-    def yield_batches():
-        """ 每次确保 `yield` 出来的 batch 维持在 `batch_size` """
-        nonlocal batch
-        while len(batch) >= batch_size:
-            yield batch[:batch_size]  # `yield` 出 `batch_size` 个文件
-            batch = batch[batch_size:]  # 保留剩余的部分
-
-    with os.scandir(folder) as entries:
-        for file_entry in entries:
-            if file_entry.is_dir():
-                if not all_files:
-                    continue
-                if re.match(r'\d{4}', file_entry.name):
-                    year = re.match(r'\d{4}', file_entry.name).group()
-                    subfolder = os.path.join(folder, year)
-                    for sub_batch in load_media_batch(subfolder, batch_size, media_type, all_files):
-                        batch.extend(sub_batch)
-                elif re.match(r'\d{2}', file_entry.name):
-                    month = re.match(r'\d{2}', file_entry.name).group()
-                    subfolder = os.path.join(folder, month)
-                    for sub_batch in load_media_batch(subfolder, batch_size, media_type, all_files):
-                        batch.extend(sub_batch)
-            elif file_entry.is_file() and file_entry.name.endswith(suffix):
-                batch.append(file_entry)  # 直接存储 DirEntry 对象
-            yield from yield_batches()
-
-    # 处理最后一批不足 batch_size 的文件
+        if file_entry.is_dir():
+            # 只进入 year/month 文件夹
+            if file_entry.path in subdirs:
+                stack.append(expand(subdirs.pop(file_entry.path).result()))
+        elif file_entry.is_file() and os.path.splitext(file_entry.name)[1].lower() in suffixes:
+            yield file_entry  # 直接返回 DirEntry 对象
+
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    """
+    把可迭代对象按 batch_size 分批，最后一批可能不足 batch_size
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
     if batch:
         yield batch
 
 
+def load_media_batch(folder: str, batch_size : int = 64, media_type : list[MediaType] = None, all_files: bool = False):
+    """
+    批量加载媒体文件，返回一个生成器，每次返回一个 batch 的媒体文件列表。
+    :param folder: 文件夹路径
+    :param batch_size: 每个 batch 的大小
+    :param media_type: 媒体类型列表，默认为 None，表示加载所有类型的媒体文件
+    :param all_files: 是否加载所有文件，False 时不加载已经处理过的文件（存放于 year/month 文件夹下）
+    """
+    batches = batched(iter_media(folder, media_type, all_files), batch_size)
+    while True:
+        # 只统计遍历文件夹的时间，不包括调用方处理 batch 的时间
+        start = time.perf_counter()
+        batch = next(batches, None)
+        if batch is None:
+            return
+        io_pool.stat_entries(batch)  # 之后各阶段用到的大小、修改时间一次并发读取
+        stats.add('scan', len(batch), time.perf_counter() - start)
+        yield batch
+
+
+def scan_media(folders: 'Folder', media_type: list[MediaType] = None, all_files: bool = False) -> list[nt.DirEntry]:
+    """
+    扫描配置中的所有文件夹，返回全部媒体文件。扫描一次后可以在多个阶段之间共用，避免重复遍历
+    """
+    entries: list[nt.DirEntry] = []
+    with stats.timer('scan'):
+        for folder in folders:
+            print(f'path: {folder.path}')
+            entries.extend(iter_media(folder.path, media_type, all_files))
+        io_pool.stat_entries(entries)  # 之后各阶段用到的大小、修改时间一次并发读取
+    stats.add('scan', len(entries))
+    return entries
+
+
 # deprecated: similarity 比较不再加载所有图片
 def read_images(image_files, mode='RGB'):
     images = []
@@ -153,23 +306,107 @@ def read_images(image_files, mode='RGB'):
     return images
 
 
+def find_related_files(image_paths: Iterable[str]) -> dict[str, list[str]]:
+    """
+    批量查找图片和同名的其他文件（如 live photo 的视频、.aae 编辑记录），删除时一起删除
+    按文件夹分组，每个文件夹只扫描一次，文件名排序后按 "文件名." 前缀二分查找
+    IMG_1.jpg 匹配 IMG_1.mov、IMG_1.jpg.aae，不匹配 IMG_10.jpg
+    :return: image_path: [path, ...]
+    """
+    by_folder: dict[str, list[str]] = defaultdict(list)
+    for path in image_paths:
+        by_folder[os.path.dirname(path)].append(path)
+
+    related = {}
+    # 各文件夹同时列出
+    listings = io_pool.map(list_dir, by_folder.keys())
+    for (folder, paths), entries in zip(by_folder.items(), listings):
+        names = sorted(entry.name for entry in entries)
+        for path in paths:
+            filename = Path(path).stem + '.'
+            i = bisect_left(names, filename)
+            matched = []
+            while i < len(names) and names[i].startswith(filename):
+                matched.append(os.path.join(folder, names[i]))
+                i += 1
+            related[path] = matched
+    return related
+
+
+def related_files(image_path: str) -> list[str]:
+    return find_related_files([image_path])[image_path]
+
+
+def move_to_trash(path: str, root: str, trash_folder: str) -> str:
+    """
+    把文件移动到回收文件夹，按相对于 root 的路径存放，同一个分区内只是重命名，不复制数据
+    回收文件夹中已经有同名文件（之前删除的同一路径）时不覆盖，改名为 a_1.jpg、a_2.jpg ...
+    :return: 回收文件夹中的路径
+    """
+    dst = os.path.join(trash_folder, os.path.relpath(path, root))
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    stem, suffix = os.path.splitext(dst)
+    n = 0
+    while os.path.exists(dst):
+        n += 1
+        dst = f'{stem}_{n}{suffix}'
+    os.rename(path, dst)
+    return dst
+
+
+def del_images(image_paths: Iterable[str], dry_run: bool = False, root: str = None, trash_folder: str = None,
+               keep: Iterable[str] = (),
+               on_removed: Callable[[str, str, str | None], None] = None) -> dict[str, list[tuple[str, str | None]]]:
+    """
+    批量删除图片及其同名文件
+    :param dry_run: 只打印，不删除
+    :param root: trash_folder 中的路径相对于该文件夹
+    :param trash_folder: 传入时移动到该文件夹而不是直接删除
+    :param keep: 需要保留的图片，和它同名的文件不会被删除（a.jpg 和 a.heic、a.mov 会互相匹配）
+    :param on_removed: 每个文件删除完成时调用 on_removed(image_path, 原路径, 回收路径)，在 io_pool 的线程中执行
+        有文件删除失败时也会先记录已经完成的文件再抛出异常
+    :return: image_path: [(原路径, 回收路径), ...]，直接删除时回收路径为 None
+    """
+    kept_stems = {os.path.splitext(path)[0] for path in keep}
+    related = find_related_files(image_paths)
+    removed = {image_path: [] for image_path in related}
+    owners = {}  # file: image_path
+    for image_path, files in related.items():
+        for file in files:
+            # 同名不同格式的图片（如 a.jpg 和 a.heic）匹配到相同的文件，同一个文件只处理一次
+            if file in owners or os.path.splitext(file)[0] in kept_stems:
+                continue
+            owners[file] = image_path
+            print('delete', file)
+
+    if dry_run:
+        return removed
+    # 删除的文件互不相关，同时执行，一个失败时其他的仍然执行完
+    def remove(file: str, image_path: str) -> str | None:
+        if trash_folder is not None:
+            dst = move_to_trash(file, root, trash_folder)
+        else:
+            os.remove(file)
+            dst = None
+        if on_removed is not None:
+            on_removed(image_path, file, dst)
+        return dst
+
+    destinations, errors = settle([io_pool.submit(remove, file, image_path) for file, image_path in owners.items()])
+    failed = {i for i, _ in errors}
+    for i, ((file, image_path), dst) in enumerate(zip(owners.items(), destinations)):
+        if i not in failed:
+            removed[image_path].append((file, dst))
+    raise_errors(errors)
+    return removed
+
+
 def del_image_dry_run(image_entry: nt.DirEntry):
-    filename = Path(image_entry.name).stem
-    folder = os.path.dirname(image_entry.path)
-    with os.scandir(folder) as entries:
-        for entry in entries:
-            if entry.name.startswith(filename):
-                print('delete', entry.name)
+    del_images([image_entry.path], dry_run=True)
 
 
 def del_image(image_entry: nt.DirEntry):
-    filename = Path(image_entry.name).stem
-    folder = os.path.dirname(image_entry.path)
-    with os.scandir(folder) as entries:
-        for entry in entries:
-            if entry.name.startswith(filename):
-                print('delete', entry.name)
-                os.remove(entry.path)
+    del_images([image_entry.path])
 
 def del_empty_folder(folder):
     if os.path.exists(folder):
@@ -184,6 +421,31 @@ def del_empty_folder(folder):
         print(f'{folder} not exists')
 
 
+def del_empty_dirs(dirs: Iterable[str], root: str):
+    """
+    只检查给定的文件夹，删除其中的空文件夹，并向上删除因此变空的上级文件夹，不会超出也不会删除 root
+    """
+    root = os.path.normpath(root)
+    # 先处理深的文件夹，子文件夹删除后上级文件夹才可能变空
+    for folder in sorted({os.path.normpath(d) for d in dirs}, key=len, reverse=True):
+        while (folder != root and folder.startswith(root + os.sep)
+               and os.path.isdir(folder) and len(os.listdir(folder)) == 0):
+            print('delete', folder)
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+
+
+# name: ZoneInfo
+_zoneinfo_cache: dict[str, ZoneInfo] = {}
+
+
+def get_zoneinfo(name: str) -> ZoneInfo:
+    zone = _zoneinfo_cache.get(name)
+    if zone is None:
+        zone = _zoneinfo_cache[name] = ZoneInfo(name)
+    return zone
+
+
 class TimeRange:
     """
     表示一个时间范围，包含起始时间和结束时间
@@ -237,7 +499,7 @@ class ZoneRange:
         # 如果 datetime 没有时区信息，则假设是当前时区
         _dt = dt
         if _dt.tzinfo is None:
-            _dt = _dt.replace(tzinfo=ZoneInfo(self.name))
+            _dt = _dt.replace(tzinfo=get_zoneinfo(self.name))
 
         # 遍历所有的时间范围，检查是否包含该 datetime
         for time_range in self.ranges:
@@ -253,12 +515,76 @@ class ZoneRange:
         return self.__str__()
 
 
+_epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class ZoneIndex:
+    """
+    把 Folder 继承的所有时区范围编译成按时间排序的区间索引，查找时二分而不是逐个 ZoneRange 比较，结果和逐个比较完全一致
+
+    没有时区信息的 datetime 在不同时区下对应的时刻不同，所以按时区名称分别建立索引：
+    所有边界转换为 UTC 后排序，边界点和相邻边界之间的开区间都是一段，记录每段中优先级最高（最内层、最靠前）的 ZoneRange。
+    查找时每个时区名称二分一次，取优先级最高的
+    """
+    def __init__(self, zones: deque[list[ZoneRange]]):
+        self.candidates: list[ZoneRange] = [zone_range for zone in zones for zone_range in zone]  # 按优先级排序
+        self.tzinfos: list[ZoneInfo] = []
+        self.boundaries: list[list[int]] = []  # 每个时区名称排序后的边界
+        self.winners: list[list[int]] = []  # 每段中优先级最高的 candidate 下标，没有匹配的为 len(candidates)
+
+        names = list(dict.fromkeys(zone_range.name for zone_range in self.candidates))
+        for name in names:
+            members = [(priority, zone_range) for priority, zone_range in enumerate(self.candidates) if zone_range.name == name]
+            bounds = sorted({self._instant(t) for _, zone_range in members for time_range in zone_range.ranges
+                             for t in (time_range.from_time, time_range.to_time)})
+            position = {t: i for i, t in enumerate(bounds)}
+
+            # 第 2i 段为 bounds[i] 之前的开区间，第 2i + 1 段为 bounds[i] 这个点
+            winners = [len(self.candidates)] * (2 * len(bounds) + 1)
+            for priority, zone_range in reversed(members):  # 倒序覆盖，最后留下的是优先级最高的
+                if not zone_range.ranges:
+                    winners = [priority] * len(winners)
+                    continue
+                for time_range in zone_range.ranges:
+                    # 闭区间 [from, to] 覆盖 from 点到 to 点之间的所有段
+                    first = 2 * position[self._instant(time_range.from_time)] + 1
+                    last = 2 * position[self._instant(time_range.to_time)] + 1
+                    for seg in range(first, last + 1):
+                        winners[seg] = priority
+
+            self.tzinfos.append(get_zoneinfo(name))
+            self.boundaries.append(bounds)
+            self.winners.append(winners)
+
+    @staticmethod
+    def _instant(dt: datetime) -> int:
+        """
+        距 UTC 1970-01-01 的微秒数，和 datetime 之间的比较结果一致，整数比较不会有精度问题
+        """
+        # 没有时区信息的边界无法和查询时间比较，由调用方退回逐个比较
+        if not isinstance(dt, datetime) or dt.tzinfo is None:
+            raise TypeError(f'{dt} has no timezone')
+        return (dt - _epoch) // timedelta(microseconds=1)
+
+    def lookup(self, dt: datetime) -> ZoneRange | None:
+        best = len(self.candidates)
+        for tzinfo, bounds, winners in zip(self.tzinfos, self.boundaries, self.winners):
+            # 和 ZoneRange.matches 一样，没有时区信息时按该时区解释
+            query = self._instant(dt.replace(tzinfo=tzinfo) if dt.tzinfo is None else dt)
+            i = bisect_left(bounds, query)
+            seg = 2 * i + 1 if i < len(bounds) and bounds[i] == query else 2 * i
+            best = min(best, winners[seg])
+        return self.candidates[best] if best < len(self.candidates) else None
+
+
 class Folder:
     def __init__(self, name: str, parent_path: str, zones: deque[list[ZoneRange]]):
         self.name: str = name
         self.path: str = cast(str, os.path.join(parent_path, name))
         self.zones: deque[list[ZoneRange]] = zones
         self.sub_folders: list[Self] = []  # 存储子文件夹的列表
+        self._zone_index: ZoneIndex | None = None  # 第一次查找时编译
+        self._zone_index_failed = False  # 有边界没有时区信息时无法编译，逐个比较
 
     def add_subfolder(self, subfolder_data: dict, zones: deque[list[ZoneRange]]=None) -> None:
         """递归创建子文件夹，并将父文件夹的时区信息传递给子文件夹"""
@@ -288,6 +614,18 @@ class Folder:
         """
         根据指定时间查找适用的时区范围
         """
+        if self._zone_index is None and not self._zone_index_failed:
+            try:
+                self._zone_index = ZoneIndex(self.zones)
+            except (TypeError, OverflowError):
+                self._zone_index_failed = True
+
+        if self._zone_index is not None:
+            zone_range = self._zone_index.lookup(dt)
+            if zone_range is None:
+                raise ValueError('no zone range')
+            return zone_range
+
         for zone in self.zones:
             for zone_range in zone:
                 if zone_range.matches(dt):
@@ -302,14 +640,14 @@ class Folder:
 
         # 如果 datetime 没有时区信息，则假设是当前时区
         if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=ZoneInfo(zone_range.name))
+            dt = dt.replace(tzinfo=get_zoneinfo(zone_range.name))
         # 如果时区范围没有指定保存时转换为的时区，则使用当前时区
         else:
-            dt = dt.astimezone(ZoneInfo(zone_range.name))
+            dt = dt.astimezone(get_zoneinfo(zone_range.name))
 
         # 如果指定了保存时转换为的时区，则转换为该时区
         if zone_range.save_as:
-            dt = dt.astimezone(ZoneInfo(zone_range.save_as))
+            dt = dt.astimezone(get_zoneinfo(zone_range.save_as))
 
         return dt
 
@@ -341,10 +679,114 @@ def load_config(config_file: str = 'folders.yaml') -> Folder:
     return Folder.create_from_data(folders.get('folder', [])[0])
 
 
+# 每个线程共用一个 exiftool 进程，避免每次调用都启动一次 perl；多线程读取元数据时各线程使用各自的进程
+_exiftool_local = threading.local()
+_exiftool_sessions: list[exiftool.ExifTool] = []
+_exiftool_lock = threading.Lock()
+
+# 流程中需要用到的 tag，一个 batch 用一次 -j 调用全部读出
+metadata_tags = (
+    'EXIF:DateTimeOriginal',
+    'EXIF:OffsetTimeOriginal',
+    'QuickTime:ContentIdentifier',
+    'MakerNotes:ContentIdentifier',
+    'QuickTime:LivePhotoAuto',
+)
+
+
+def get_exiftool() -> exiftool.ExifTool:
+    """
+    获取当前线程的 exiftool 进程，第一次调用时启动，进程退出时关闭
+    """
+    session = getattr(_exiftool_local, 'session', None)
+    if session is None or not session.running:
+        session = exiftool.ExifTool()
+        session.start()
+        _exiftool_local.session = session
+        with _exiftool_lock:
+            _exiftool_sessions.append(session)
+    return session
+
+
+def close_exiftool():
+    with _exiftool_lock:
+        for session in _exiftool_sessions:
+            session.terminate()
+        _exiftool_sessions.clear()
+
+
+atexit.register(close_exiftool)
+
+
+class MediaMetadata:
+    """
+    单个文件的元数据记录，由 read_metadata_batch 批量读取，各个 get_xxx 函数都从这里取值
+    """
+    def __init__(self, path: str, tags: dict):
+        self.path = path
+        self.date_time_original = tags.get('EXIF:DateTimeOriginal')
+        self.offset_time_original = tags.get('EXIF:OffsetTimeOriginal')
+        # IOS 16 以下可能会是 MediaGroupUUID，不确定
+        self.content_identifier = tags.get('QuickTime:ContentIdentifier') or tags.get('MakerNotes:ContentIdentifier')
+        self.live_photo_auto = tags.get('QuickTime:LivePhotoAuto')
+
+    def get_datetime_original(self) -> datetime | None:
+        """
+        EXIF 中的 DateTimeOriginal + OffsetTimeOriginal，缺任意一个时返回 None
+        """
+        if self.date_time_original and self.offset_time_original:
+            # 有时区偏移 → 拼接并用 %z 解析
+            dt_str = f"{self.date_time_original} {self.offset_time_original}"
+            return datetime.strptime(dt_str, '%Y:%m:%d %H:%M:%S %z')
+        return None
+
+    def __repr__(self):
+        return f'MediaMetadata({self.path}, {self.date_time_original} {self.offset_time_original}, {self.content_identifier})'
+
+
+# path: MediaMetadata，read_metadata_batch 读到的记录都缓存在这里
+_metadata_cache: dict[str, MediaMetadata] = {}
+
+
+def read_metadata_batch(entries: list[nt.DirEntry]) -> dict[str, MediaMetadata]:
+    """
+    用一次 exiftool -j 调用读取一个 batch 所有文件需要的 tag
+    :param entries: load_media_batch 返回的 batch
+    :return: path: MediaMetadata
+    """
+    paths = [entry.path for entry in entries if entry.path not in _metadata_cache]
+    if paths:
+        with stats.timer('metadata', len(paths)):
+            results = get_exiftool().get_tags_batch(metadata_tags, paths)
+
+        # exiftool 输出的 SourceFile 分隔符可能和传入的不一样，统一 normpath 后再对应
+        tags_map = {os.path.normpath(tags['SourceFile']): tags for tags in results}
+        for path in paths:
+            _metadata_cache[path] = MediaMetadata(path, tags_map.get(os.path.normpath(path), {}))
+
+    return {entry.path: _metadata_cache[entry.path] for entry in entries}
+
+
+def get_metadata_record(file: nt.DirEntry) -> MediaMetadata:
+    """
+    获取文件的元数据记录，已经批量读取过的直接返回缓存
+    """
+    record = _metadata_cache.get(file.path)
+    if record is None:
+        record = read_metadata_batch([file])[file.path]
+    return record
+
+
+def forget_metadata(entries: list[nt.DirEntry]):
+    """
+    文件被移动或删除后，从缓存中移除对应的记录
+    """
+    for entry in entries:
+        _metadata_cache.pop(entry.path, None)
+
+
 def get_metadata(file: nt.DirEntry):
-    with exiftool.ExifTool() as et:
-        metadata = et.get_metadata(file.path)
-        return metadata
+    return get_exiftool().get_metadata(file.path)
 
 
 def get_image_time(file: nt.DirEntry) -> datetime:
@@ -353,20 +795,13 @@ def get_image_time(file: nt.DirEntry) -> datetime:
     - 优先 EXIF 中的 DateTimeOriginal + OffsetTimeOriginal
     - fallback: 使用文件系统修改时间（mtime），不要带时区，因为时间似乎是对的，只是时区是本地时区。后面判断出时区后替换掉时区即可
     """
-    with exiftool.ExifTool() as et:
-        date_time_original = et.get_tag("EXIF:DateTimeOriginal", file.path)
-        offset_time_original = et.get_tag("EXIF:OffsetTimeOriginal", file.path)
-
-        if date_time_original and offset_time_original:
-            # 有时区偏移 → 拼接并用 %z 解析
-            dt_str = f"{date_time_original} {offset_time_original}"
-            dt = datetime.strptime(dt_str, '%Y:%m:%d %H:%M:%S %z')
-
-            return dt
+    dt = get_metadata_record(file).get_datetime_original()
+    if dt is not None:
+        return dt
 
-        # fallback: 使用文件修改时间
-        mtime = os.path.getmtime(file.path)
-        return datetime.fromtimestamp(mtime)
+    # fallback: 使用文件修改时间
+    mtime = file.stat().st_mtime
+    return datetime.fromtimestamp(mtime)
 
 
 def get_media_time(file: nt.DirEntry) -> datetime:
@@ -377,7 +812,7 @@ def get_media_time(file: nt.DirEntry) -> datetime:
         return get_image_time(file)
     else:
         # 对于其他类型的文件，直接使用 mtime
-        mtime = os.path.getmtime(file.path)
+        mtime = file.stat().st_mtime
         return datetime.fromtimestamp(mtime)
 
 
@@ -387,31 +822,21 @@ def get_mtime(file: nt.DirEntry) -> datetime:
     - 若有 EXIF 中的 DateTimeOriginal + OffsetTimeOriginal，则解析并转为 UTC。
     - 否则使用文件系统的 mtime
     """
-    with exiftool.ExifTool() as et:
-        date_time_original = et.get_tag("EXIF:DateTimeOriginal", file.path)
-        offset_time_original = et.get_tag("EXIF:OffsetTimeOriginal", file.path)
-
-    if date_time_original and offset_time_original:
-        # 解析 EXIF 中的时间
-        dt_str = f"{date_time_original} {offset_time_original}"
-        dt = datetime.strptime(dt_str, '%Y:%m:%d %H:%M:%S %z')
+    dt = get_metadata_record(file).get_datetime_original()
+    if dt is not None:
         return dt.astimezone(timezone.utc)
     else:
         # 使用文件系统的修改时间
-        mtime = os.stat(file.path).st_mtime
+        mtime = file.stat().st_mtime
         return datetime.fromtimestamp(mtime, tz=timezone.utc)
 
 
 def is_live_photo(file: nt.DirEntry):
-    with exiftool.ExifTool() as et:
-        return et.get_tag("QuickTime:LivePhotoAuto", file.path) == 1
+    return get_metadata_record(file).live_photo_auto == 1
 
 
 def get_content_uuid(file: nt.DirEntry):
-    with exiftool.ExifTool() as et:
-        uuid = et.get_tag("QuickTime:ContentIdentifier", file.path) or et.get_tag("MakerNotes:ContentIdentifier", file.path)
-        # IOS 16 以下可能会是 MediaGroupUUID，不确定
-        return uuid
+    return get_metadata_record(file).content_identifier
 
 
 # before rename, get the file map
@@ -421,6 +846,9 @@ def get_file_entry_map(entries: [nt.DirEntry]):
         '': []  # files without UUID
     }  # UUID: [entry1, entry2, ...]
 
+    # 一次读出整个 batch 的元数据
+    read_metadata_batch(entries)
+
     for file_entry in entries:
         content_uuid = get_content_uuid(file_entry)
         if content_uuid:
@@ -434,56 +862,126 @@ def get_file_entry_map(entries: [nt.DirEntry]):
     for content_uuid, file_entry_list in file_entry_map.items():
         if content_uuid == '':
             continue
-        last_modified_time = os.stat(file_entry_list[0]).st_mtime
+        last_modified_time = file_entry_list[0].stat().st_mtime
         for file_entry in file_entry_list:
-            if os.stat(file_entry).st_mtime != last_modified_time:
+            if file_entry.stat().st_mtime != last_modified_time:
                 print(f'Warning: {file_entry} has different last modified time')
 
     return file_entry_map
 
 
-def raw_to_jpg(file: nt.DirEntry, thumbnail: bool = False):
+class RawMode(Enum):
     """
-    将原始图像文件转换为 JPG 文件。
-    如果 thumbnail 为 True，则提取缩略图，否则使用 rawpy 读取并处理。
+    RAW 转 JPG 的速度/质量档位
     """
-    if file.name.endswith(raw_img_suffix):
-        if thumbnail:
-            # 提取缩略图
-            with rawpy.imread(file.path) as raw:
-                thumbnail = raw.extract_thumb()
+    FULL = 'full'  # 完整解马赛克，最慢
+    HALF = 'half'  # half_size 解码，分辨率减半，速度约快 4 倍
+    THUMBNAIL = 'thumbnail'  # 直接使用内嵌的 JPEG 预览图，最快
+
+
+# 转换过程中的临时文件夹，转换完成后原子地移动到目标位置
+raw_tmp_folder = '.raw_to_jpg'
 
-            filename = file.path.replace(Path(file.name).suffix, '.jpg')
 
-            if thumbnail.format == rawpy.ThumbFormat.JPEG:
+def decode_raw(src_path: str, dst_path: str, mode: str):
+    """
+    将 RAW 文件解码并保存为 JPG，只传路径，可以在进程池中运行
+    :param mode: RawMode 的值
+    """
+    with rawpy.imread(src_path) as raw:
+        if mode == RawMode.THUMBNAIL.value:
+            try:
+                thumbnail = raw.extract_thumb()
+            except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+                thumbnail = None
+
+            if thumbnail is not None and thumbnail.format == rawpy.ThumbFormat.JPEG:
                 # 'thumbnail.data' is the full JPEG buffer
-                with open(filename, 'wb') as f:
+                with open(dst_path, 'wb') as f:
                     f.write(thumbnail.data)
+                return
+            # 没有 JPEG 预览图时退回 half_size 解码
+            rgb = thumbnail.data if thumbnail is not None else raw.postprocess(half_size=True)
         else:
-            with rawpy.imread(file.path) as raw:
-                # 后处理为 RGB 图像
-                rgb = raw.postprocess()
-
-            # 使用 Pillow 将 RGB 图像保存为 JPG
-            filename = file.path.replace(Path(file.name).suffix, '.jpg')
-            img = Image.fromarray(rgb)
+            # 后处理为 RGB 图像
+            rgb = raw.postprocess(half_size=(mode == RawMode.HALF.value))
 
-            img = img.convert('RGB')  # 转换为 RGB 模式
-            img.save(filename)
+    # 使用 Pillow 将 RGB 图像保存为 JPG
+    img = Image.fromarray(rgb)
+    img = img.convert('RGB')  # 转换为 RGB 模式
+    img.save(dst_path, format='JPEG')
 
-        # 提取原始文件的 EXIF 和 XMP 元数据，使用 exiftool
-        with exiftool.ExifTool() as et:
-            et.execute(
-                "-overwrite_original".encode('utf-8'),
-                f"-TagsFromFile={file.path}".encode('utf8'),
-                os.path.join(os.path.dirname(file.path), filename).encode('utf8'),
-            )
 
+def raw_to_jpg_batch(files: list[nt.DirEntry], mode: RawMode = RawMode.FULL, executor: Executor = None):
+    """
+    批量将 RAW 文件转换为同名的 JPG 文件：
+    - 解码在 executor（进程池）中并发执行，先写入同文件夹下的临时文件夹，临时文件按原文件名区分（a.CR3.jpg）
+    - 一次 exiftool 调用复制整个 batch 的 EXIF 和 XMP 元数据
+    - 再移动到目标位置，设置修改时间并删除原文件
+    同名的 JPG 已经存在（RAW+JPEG 拍摄）或 batch 中另一个 RAW（a.CR3 和 a.NEF）已经使用该文件名时不转换，保留 RAW
+    """
+    # 同时按文件头判断，后缀是 RAW 但内容不是的文件（如改了后缀的 JPG）不处理
+    formats = detect_formats([file for file in files if file.name.endswith(raw_img_suffix)])
+    files = [file for file in files if formats.get(file.path) in raw_formats]
+
+    targets = {}  # file.path: 目标 JPG 路径
+    for file in files:
+        filename = os.path.join(os.path.dirname(file.path), Path(file.name).stem + '.jpg')
+        if filename in targets.values():
+            print(f'{file.name}: {filename} is used by another file, keep original')
+        elif os.path.exists(filename):
+            print(f'{filename} already exists, skip {file.name}')
+        else:
+            targets[file.path] = filename
+    files = [file for file in files if file.path in targets]
+    if not files:
+        return
+
+    tmp_paths = []
+    for file in files:
+        tmp_folder = os.path.join(os.path.dirname(file.path), raw_tmp_folder)
+        os.makedirs(tmp_folder, exist_ok=True)
+        tmp_paths.append(os.path.join(tmp_folder, file.name + '.jpg'))
+
+    if executor is None:
+        for file, tmp_path in zip(files, tmp_paths):
+            decode_raw(file.path, tmp_path, mode.value)
+    else:
+        for _ in executor.map(decode_raw, [file.path for file in files], tmp_paths, [mode.value] * len(files)):
+            pass
+
+    # 提取原始文件的 EXIF 和 XMP 元数据，使用 exiftool
+    # %d%f 为临时文件的文件夹和去掉 .jpg 的文件名，对应的原文件为 临时文件夹/../原文件名
+    get_exiftool().execute(
+        "-overwrite_original".encode('utf-8'),
+        "-TagsFromFile".encode('utf-8'),
+        "%d../%f".encode('utf8'),
+        *[path.encode('utf8') for path in tmp_paths],
+    )
+
+    for file, tmp_path in zip(files, tmp_paths):
+        filename = targets[file.path]
+        if os.path.exists(filename):
+            # 转换期间出现了同名的 JPG，不覆盖
+            print(f'{filename} already exists, skip {file.name}')
+            os.remove(tmp_path)
+            continue
+        os.rename(tmp_path, filename)
         # 设置修改时间为原文件的修改时间
         os.utime(filename, (file.stat().st_atime, file.stat().st_mtime))
-
         os.remove(file.path)
 
+    for tmp_folder in {os.path.dirname(path) for path in tmp_paths}:
+        if len(os.listdir(tmp_folder)) == 0:
+            os.rmdir(tmp_folder)
+
+
+def raw_to_jpg(file: nt.DirEntry, thumbnail: bool = False):
+    """
+    将原始图像文件转换为 JPG 文件。
+    如果 thumbnail 为 True，则提取缩略图，否则使用 rawpy 读取并处理。
+    """
+    raw_to_jpg_batch([file], RawMode.THUMBNAIL if thumbnail else RawMode.FULL)
 
 
 def has_unique_suffix(file_entry_list: list[nt.DirEntry]) -> bool:
@@ -517,12 +1015,12 @@ def get_image_raw_size(image_entry: nt.DirEntry) -> int:
     """
     获取图片字节数（宽 * 高 * 通道数）
     """
-    image = Image.open(image_entry.path)
-    return image.size[0] * image.size[1] * len(image.getbands())
+    with Image.open(image_entry.path) as image:
+        return image.size[0] * image.size[1] * len(image.getbands())
 
 
 if __name__ == '__main__':
     folder = r"D:\csc\Pictures\All\旅行\Arizona\Page\Antelope Canyon\2024\04"
-    for batch in load_media_batch(folder, 64):
-        for file_entry in batch:
-            raw_to_jpg(file_entry, thumbnail=True)
\ No newline at end of file
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for batch in load_media_batch(folder, 64, media_type=[MediaType.RAW_IMAGE]):
+            raw_to_jpg_batch(batch, RawMode.THUMBNAIL, executor)
\ No newline at end of file
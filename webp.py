@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+import utils
+from hash_index import HashIndex
+
+
+# 需要转换为 webp 的格式
+webp_suffix = ('.jpg', '.jpeg', '.png')
+
+# webp 能无损保存的像素格式，其他格式（16 位 PNG 的 I;16、I，CMYK 等）转换时会截断或改变颜色，跳过
+webp_modes = ('L', 'LA', 'RGB', 'RGBA', 'P')
+
+
+def webp_path(src_path: str) -> str:
+    return str(Path(src_path).with_suffix('.webp'))
+
+
+def to_webp(src_path: str, quality: int = 90) -> tuple[int, int | None]:
+    """
+    将图片转换为同名的 webp，只保留体积更小的文件，只传路径，可以在进程池中运行
+    webp 更小时删除原文件，否则删除 webp
+    像素格式不在 webp_modes 中，或者同名的 webp 已经存在时不转换
+    :return: (原文件大小, webp 大小)，没有转换时 webp 大小为 None
+    """
+    dst_path = webp_path(src_path)
+    tmp_path = f'{src_path}.webp.tmp'  # 按原文件名区分，a.jpg 和 a.png 不会写同一个临时文件
+    stat = os.stat(src_path)
+    if os.path.exists(dst_path):
+        print(f'{dst_path} already exists, skip {src_path}')
+        return stat.st_size, None
+
+    with Image.open(src_path) as img:
+        if img.mode not in webp_modes:
+            print(f'{src_path}: mode {img.mode} is not supported by webp, skip')
+            return stat.st_size, None
+        # 保留 exif、icc 和 xmp 数据
+        params = {'quality': quality}
+        for key in ('exif', 'icc_profile', 'xmp'):
+            if img.info.get(key):
+                params[key] = img.info[key]
+        img.save(tmp_path, format='WEBP', **params)
+
+    original_size = stat.st_size
+    converted_size = os.path.getsize(tmp_path)
+    if converted_size > original_size:
+        # 如果转换后的文件更大，删除转换后的文件，保留原文件
+        os.remove(tmp_path)
+    elif os.path.exists(dst_path):
+        # 转换期间出现了同名的 webp，不覆盖
+        print(f'{dst_path} already exists, skip {src_path}')
+        os.remove(tmp_path)
+        return original_size, None
+    else:
+        # 如果转换后的文件更小或一样大，删除原文件
+        os.replace(tmp_path, dst_path)
+        # 设置修改时间为原文件的修改时间
+        os.utime(dst_path, (stat.st_atime, stat.st_mtime))
+        os.remove(src_path)
+    return original_size, converted_size
+
+
+def compress_folder(folder: str, hash_index: HashIndex, executor: Executor = None, quality: int = 90):
+    """
+    将文件夹（包括 year/month 子文件夹）下的 jpg、png 转换为 webp
+    转换后更大或像素格式不支持而保留下来的文件记录在 hash_index 中，再次运行时跳过，不重新编码
+    同一个文件夹中 a.jpg 和 a.png 会转换为同一个 a.webp，只转换第一个
+    """
+    print(f'path: {folder}')
+    kept = hash_index.get_processed('webp')
+    claimed = set()  # 已经分配给某个文件的 webp 路径
+
+    batch_num = 0
+    for batch in utils.load_media_batch(folder, 64, media_type=[utils.MediaType.IMAGE], all_files=True):
+        entries = []
+        for entry in batch:
+            if not entry.name.lower().endswith(webp_suffix):
+                continue
+            stat = entry.stat()
+            if kept.get(hash_index.relative_path(entry.path)) == (stat.st_size, stat.st_mtime):
+                continue
+            dst_path = webp_path(entry.path)
+            if dst_path in claimed:
+                print(f'{entry.name}: {dst_path} is used by another file, keep original')
+                continue
+            claimed.add(dst_path)
+            entries.append(entry)
+
+        print(f'batch {batch_num}, size {len(entries)}')
+        paths = [entry.path for entry in entries]
+        if executor is None:
+            results = map(to_webp, paths, [quality] * len(paths))
+        else:
+            results = executor.map(to_webp, paths, [quality] * len(paths))
+
+        kept_files = []
+        for entry, (original_size, converted_size) in zip(entries, results):
+            if converted_size is None:
+                if os.path.exists(entry.path) and not os.path.exists(webp_path(entry.path)):
+                    kept_files.append((entry.path, entry.stat().st_size, entry.stat().st_mtime))  # 像素格式不支持
+            elif converted_size > original_size:
+                print(f'{entry.name}: converted file is larger than original, keep original')
+                kept_files.append((entry.path, entry.stat().st_size, entry.stat().st_mtime))
+            else:
+                print(f'{entry.name}: {utils.file_size_to_str(original_size)} -> {utils.file_size_to_str(converted_size)}')
+        hash_index.put_processed('webp', kept_files)
+        batch_num += 1
+
+
+if __name__ == '__main__':
+    folders = utils.load_config('folders.yaml')
+
+    with HashIndex(os.path.join(folders.path, 'cache.db')) as hash_index, \
+            ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for folder in folders:
+            compress_folder(folder.path, hash_index, executor, quality=90)